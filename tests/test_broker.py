@@ -0,0 +1,167 @@
+""" Tests for the broker """
+
+import os
+import shutil
+import tempfile
+import unittest
+import zmq
+import zerotask
+from zerotask import journal
+from zerotask import jsonrpc
+from zerotask.exceptions import JSONRPCError
+from zerotask.broker import Broker
+
+
+class TestJournaledBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.context = zmq.Context()
+        self.started = 0 # brokers so far, each on its own address
+        self.broker = self.start_broker()
+
+    def tearDown(self):
+        self.broker.journal.close()
+        self.context.destroy(linger=0)
+        shutil.rmtree(self.path)
+
+    def start_broker(self):
+        """ Returns a broker that keeps what it sends in self.sent """
+        self.started += 1
+        broker = Broker(journal=os.path.join(self.path, "journal"),
+                        protocol="inproc", address="broker-%d" % self.started,
+                        context=self.context)
+        self.sent = []
+        broker.send = lambda socket, message, envelope=None: \
+            self.sent.append((socket, message))
+        return broker
+
+    def published(self):
+        """ Returns the messages sent on the publish socket """
+        return [message for socket, message in self.sent
+                if socket is self.broker.publish_socket]
+
+    def ready_node(self, methods=None):
+        """ Connects a node with a credit, and returns its id """
+        node_id = self.broker.node_connect(methods=methods)
+        self.broker.current_envelope = [node_id, ""]
+        self.broker.node_ready(node_id)
+        return node_id
+
+    def finish_task(self):
+        """ Runs a task through to its result, and returns its id """
+        client_id = self.broker.client_connect()
+        task_id = self.broker.client_new_task(client_id, "add", [1, 2])
+        node_id = self.ready_node()
+        self.broker.commit()
+        self.broker.node_task_finished(node_id, task_id, 3)
+        return task_id
+
+    def test_results_are_announced_after_the_commit(self):
+        task_id = self.finish_task()
+        self.assertTrue(self.broker.journal.pending())
+        self.assertEqual(self.published(), [])
+        self.broker.commit()
+        announced = self.published()
+        self.assertEqual(len(announced), 1)
+        self.assertEqual(announced[0]["params"], dict(task_id=task_id))
+
+    def test_results_survive_a_restart(self):
+        task_id = self.finish_task()
+        self.broker.commit()
+        self.broker.journal.close()
+        self.broker = self.start_broker()
+        client_id = task_id.split("-", 1)[0]
+        self.assertEqual(self.broker.client_task_result(client_id, task_id),
+                         3)
+
+    def test_stale_results_are_ignored(self):
+        client_id = self.broker.client_connect()
+        task_id = self.broker.client_new_task(client_id, "add", [1, 2])
+        first_node = self.ready_node()
+        # the first node goes quiet, so the task is run again elsewhere
+        self.broker.node_disconnect(first_node)
+        second_node = self.ready_node()
+        self.assertEqual(self.broker.tasks[task_id]["_node"], second_node)
+        self.broker.node_connect(node_id=first_node)
+        self.assertFalse(self.broker.node_task_finished(first_node,
+                                                        task_id, 3))
+        self.assertTrue(self.broker.node_task_finished(second_node,
+                                                       task_id, 3))
+        self.assertFalse(self.broker.node_task_finished(second_node,
+                                                        task_id, 3))
+        self.assertEqual(self.broker.node_task_results(
+            second_node, [dict(task_id=task_id, result=3)]), 0)
+        finished = [line for line in self.broker.journal.buffer
+                    if journal.FINISHED in line]
+        self.assertEqual(len(finished), 1)
+        self.broker.commit()
+        self.assertEqual(len(self.published()), 1)
+
+    def test_unassigned_results_are_ignored(self):
+        client_id = self.broker.client_connect()
+        task_id = self.broker.client_new_task(client_id, "add", [1, 2])
+        node_id = self.ready_node(methods=["subtract"])
+        self.assertFalse(self.broker.node_task_failed(node_id, task_id,
+                                                      dict(code=1)))
+        self.assertEqual(self.broker.tasks[task_id]["_status"],
+                         zerotask.QUEUED)
+
+    def test_results_are_counted_once(self):
+        self.broker.max_memory = 1000
+        task_id = self.finish_task()
+        size = self.broker.result_bytes
+        self.assertTrue(size > 0)
+        self.broker.retain_result(task_id, self.broker.tasks[task_id])
+        self.assertEqual(self.broker.result_bytes, size)
+
+    def test_spilled_result_without_a_store(self):
+        task_id = self.finish_task()
+        task = self.broker.tasks[task_id]
+        # as restored from a snapshot taken with a spill path
+        del task["result"]
+        task["_spilled"] = True
+        client_id = task_id.split("-", 1)[0]
+        try:
+            self.broker.client_task_result(client_id, task_id)
+        except JSONRPCError, error:
+            self.assertEqual(error.code, jsonrpc.RESULT_EXPIRED)
+        else:
+            self.fail("Expected an expired result")
+        self.assertFalse(self.broker.tasks.has_key(task_id))
+
+    def test_bad_batches_queue_nothing(self):
+        client_id = self.broker.client_connect()
+        batch = [dict(method="add", params=[1, 2]),
+                 dict(method="add", params=dict(first=1), chunk=True)]
+        try:
+            self.broker.client_new_tasks(client_id, batch)
+        except JSONRPCError, error:
+            self.assertEqual(error.code, jsonrpc.INVALID_PARAMETERS)
+        else:
+            self.fail("Expected invalid parameters")
+        self.assertEqual(self.broker.tasks, {})
+
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.broker = Broker(protocol="inproc", address="broker",
+                             context=self.context)
+
+    def tearDown(self):
+        self.context.destroy(linger=0)
+
+    def test_uncacheable_params_still_queue(self):
+        self.broker.pure_methods.add("echo")
+        client_id = self.broker.client_connect()
+        task_id = self.broker.client_new_task(client_id, "echo", ["\xff"])
+        task = self.broker.tasks[task_id]
+        self.assertEqual(task["_status"], zerotask.QUEUED)
+        self.assertFalse(task.has_key("_key"))
+        self.assertEqual(list(self.broker.queues["echo"]), [task_id])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,23 @@
+""" Tests for the client helpers """
+
+import unittest
+from zerotask.client import chain_steps
+
+
+class TestChainSteps(unittest.TestCase):
+
+    def test_results_are_passed_along(self):
+        steps, last = chain_steps([("load", dict(path="a")),
+                                   ("add", (2,)), ("save", [])])
+        self.assertEqual(last, "2")
+        self.assertEqual(steps["0"]["params"], dict(path="a"))
+        self.assertEqual(steps["1"]["params"], [{"$result": "0"}, 2])
+        self.assertEqual(steps["2"]["params"], [{"$result": "1"}])
+
+    def test_keyword_params_after_the_first(self):
+        self.assertRaises(ValueError, chain_steps,
+                          [("load", []), ("add", dict(amount=2))])
+
+
+if __name__ == "__main__":
+    unittest.main()
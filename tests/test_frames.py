@@ -0,0 +1,60 @@
+""" Tests for the multipart message helpers """
+
+import threading
+import unittest
+import zmq
+from zerotask import codec
+from zerotask import frames
+from zerotask import jsonrpc
+from zerotask.broker import Broker
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_router(self):
+        self.assertEqual(frames.split(zmq.ROUTER, ["id", "", "body", "a"]),
+                         (["id", ""], "body", ["a"]))
+
+    def test_router_without_delimiter(self):
+        self.assertRaises(frames.MalformedMessage, frames.split,
+                          zmq.ROUTER, ["id", "body"])
+
+    def test_router_without_body(self):
+        self.assertRaises(frames.MalformedMessage, frames.split,
+                          zmq.ROUTER, ["id", ""])
+
+    def test_dealer_without_body(self):
+        self.assertRaises(frames.MalformedMessage, frames.split,
+                          zmq.DEALER, [""])
+
+
+class TestMalformedPeers(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.broker = Broker(protocol="inproc", address="frames",
+                             context=self.context)
+        self.thread = threading.Thread(target=self.broker.start)
+        self.thread.start()
+        self.peer = self.context.socket(zmq.DEALER)
+        self.peer.connect("inproc://frames:5555")
+
+    def tearDown(self):
+        self.broker.stop()
+        self.thread.join(5)
+        self.context.destroy(linger=0)
+
+    def test_broker_survives_bad_messages(self):
+        request = codec.get_codec().encode(
+            jsonrpc.request("zerotask.broker.client_connect", []))
+        self.peer.send_multipart([request]) # no delimiter
+        self.peer.send_multipart(["", "{not json"])
+        self.peer.send_multipart(["", request])
+        self.assertTrue(self.peer.poll(5000))
+        envelope, reply = frames.recv(self.peer)
+        self.assertTrue(reply.has_key("result"))
+        self.assertTrue(self.thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+""" Tests for the broker journal """
+
+import os
+import shutil
+import tempfile
+import unittest
+import zerotask
+from zerotask import journal
+
+
+def queued(method="add", params=(1, 2)):
+    """ Returns a freshly queued task """
+    return dict(method=method, params=list(params),
+                _status=zerotask.QUEUED, id="task")
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.path, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open_journal(self, **kwargs):
+        """ Returns a replayed journal, and the tasks and clients """
+        task_journal = journal.Journal(self.journal_path, **kwargs)
+        tasks, clients = task_journal.replay()
+        self.addCleanup(task_journal.close)
+        return task_journal, tasks, clients
+
+    def test_replay(self):
+        task_journal, tasks, clients = self.open_journal()
+        task_journal.append(journal.CLIENT, "client", {})
+        task_journal.append(journal.QUEUED, "client-a", queued())
+        task_journal.append(journal.QUEUED, "client-b", queued())
+        task_journal.append(journal.ASSIGNED, "client-a", "node")
+        task_journal.append(journal.FINISHED, "client-b", 3)
+        task_journal.close()
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(clients.keys(), ["client"])
+        self.assertEqual(sorted(tasks.keys()), ["client-a", "client-b"])
+        self.assertEqual(tasks["client-a"]["_status"], zerotask.ASSIGNED)
+        self.assertEqual(tasks["client-a"]["_node"], "node")
+        self.assertEqual(tasks["client-b"]["_status"], zerotask.FINISHED)
+        self.assertEqual(tasks["client-b"]["result"], 3)
+        self.assertEqual(task_journal.records, 5)
+
+    def test_uncommitted_records_are_lost(self):
+        task_journal, tasks, clients = self.open_journal()
+        task_journal.append(journal.QUEUED, "client-a", queued())
+        task_journal.commit()
+        task_journal.append(journal.QUEUED, "client-b", queued())
+        task_journal.file.close() # a crash, before the next commit
+        task_journal.file = None
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(sorted(tasks.keys()), ["client-a"])
+
+    def test_torn_tail(self):
+        task_journal, tasks, clients = self.open_journal()
+        task_journal.append(journal.QUEUED, "client-a", queued())
+        task_journal.close()
+        with open(self.journal_path, "a") as journal_file:
+            journal_file.write('["queued", "client-b", {"meth')
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(sorted(tasks.keys()), ["client-a"])
+        # the next records have to survive the replay after this one
+        task_journal.append(journal.QUEUED, "client-c", queued())
+        task_journal.close()
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(sorted(tasks.keys()), ["client-a", "client-c"])
+        self.assertEqual(task_journal.records, 2)
+
+    def test_compaction(self):
+        task_journal, tasks, clients = self.open_journal(compact_size=3)
+        state = {}
+        for task_id in ("client-a", "client-b", "client-c"):
+            state[task_id] = queued()
+            task_journal.append(journal.QUEUED, task_id, state[task_id])
+        task_journal.commit()
+        self.assertTrue(task_journal.needs_compaction())
+        task_journal.compact(state, dict(client={}))
+        self.assertFalse(task_journal.needs_compaction())
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        # records after the snapshot go on top of it
+        task_journal.append(journal.COLLECTED, "client-b")
+        task_journal.close()
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(sorted(tasks.keys()), ["client-a", "client-c"])
+        self.assertEqual(clients, dict(client={}))
+        self.assertEqual(task_journal.records, 1)
+
+    def test_binary_data(self):
+        task_journal, tasks, clients = self.open_journal()
+        task_journal.append(journal.QUEUED, "client-a", queued())
+        task_journal.append(journal.FINISHED, "client-a",
+                            bytearray("\x00\xff"))
+        task_journal.close()
+        task_journal, tasks, clients = self.open_journal()
+        self.assertEqual(tasks["client-a"]["result"], bytearray("\x00\xff"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+""" Tests for the node """
+
+import time
+import unittest
+from zerotask import node
+from zerotask.node import Node
+
+
+class TestPendingRequests(unittest.TestCase):
+
+    def setUp(self):
+        # only the request bookkeeping, without any sockets
+        self.node = Node.__new__(Node)
+        self.node.pending_requests = {}
+
+    def test_unanswered_requests_expire(self):
+        now = time.time()
+        self.node.pending_requests["old"] = (
+            "zerotask.broker.node_heartbeat", None, "tcp://broker",
+            now - node.REQUEST_TIMEOUT - 1)
+        self.node.pending_requests["new"] = (
+            "zerotask.broker.node_heartbeat", None, "tcp://broker", now)
+        self.node.expire_requests()
+        self.assertEqual(self.node.pending_requests.keys(), ["new"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+""" Tests for the spilled result store """
+
+import os
+import shutil
+import tempfile
+import unittest
+from zerotask.store import ResultStore
+
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = ResultStore(os.path.join(self.path, "results"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        self.store.put("client-task", dict(answer=42))
+        self.assertEqual(self.store.get("client-task"), dict(answer=42))
+        self.store.delete("client-task")
+        self.assertEqual(os.listdir(self.store.path), [])
+
+    def test_task_ids_stay_in_the_store(self):
+        for task_id in ("client-../../escaped", u"client-/tmp/x\u00e9"):
+            filename = self.store.filename(task_id)
+            self.assertEqual(os.path.dirname(filename), self.store.path)
+            self.store.put(task_id, "result")
+            self.assertEqual(self.store.get(task_id), "result")
+        self.assertEqual(os.listdir(self.path), ["results"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+""" A throughput / latency benchmark for the broker-node-client pipeline.
+
+Starts a Broker, some Nodes and some client processes on this machine
+(over tcp loopback or ipc), has every client push tasks through with a
+fixed number in flight, and reports tasks/sec plus end-to-end latency
+percentiles. Every combination of the swept options gets a fresh broker
+and nodes. The output is JSON, tagged with the git revision, and an
+earlier run can be passed to --compare to see what changed.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import logging
+import optparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import multiprocessing
+from zerotask.broker import Broker
+from zerotask.node import Node
+from zerotask.client import AsyncClient
+from zerotask.task import task
+from zerotask import worker
+
+METHOD = "benchmark.echo"
+STARTUP_DELAY = 1 # seconds for nodes to connect before clients start
+SHUTDOWN_TIMEOUT = 5 # seconds to wait for a process to stop on SIGINT
+
+
+@task(name=METHOD)
+def echo(payload):
+    """ Sends the payload straight back """
+    return payload
+
+
+def percentile(values, fraction):
+    """ Returns the value at fraction (0-1) of the sorted values """
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+def revision():
+    """ Returns the git revision of the working tree, if there is one """
+    try:
+        path = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=path, stderr=subprocess.PIPE)
+        return output.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def stop_process(process):
+    """ Interrupts a process, so it tears down (and stops its workers),
+    then kills it if it doesn't stop in time
+    """
+    if process.is_alive():
+        os.kill(process.pid, signal.SIGINT)
+    process.join(SHUTDOWN_TIMEOUT)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+
+def run_broker(options):
+    """ The broker process """
+    Broker(**options).start()
+
+def run_node(request_uri, subscribe_uri, options):
+    """ A node process """
+    node = Node(**options)
+    node.add_broker(request_uri, subscribe_uri)
+    node.start()
+
+def run_client(request_uri, subscribe_uri, config, ready, go, results):
+    """ A client process. Keeps config["concurrency"] tasks in flight
+    until config["tasks"] have finished, and puts its latencies (in
+    seconds) on the results queue.
+    """
+    # the parent's interrupt handling is for the broker and nodes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    client = AsyncClient(request_uri, subscribe_uri, codec=config["codec"])
+    payload = "x" * config["payload"]
+    for i in range(config["warmup"]):
+        client._dispatch(METHOD, payload).wait()
+    slots = threading.Semaphore(config["concurrency"])
+    latencies = []
+    errors = []
+    finished = threading.Event()
+    if not config["tasks"]:
+        finished.set() # nothing to wait for
+
+    def track(sent):
+        """ Returns the callback / errback pair for one task """
+        def done(result):
+            """ Records the latency and frees the slot """
+            latencies.append(time.time() - sent)
+            complete()
+        def failed(error):
+            """ Records the error and frees the slot """
+            errors.append(str(error))
+            complete()
+        def complete():
+            """ Frees the slot and checks if that was the last task """
+            slots.release()
+            if len(latencies) + len(errors) == config["tasks"]:
+                finished.set()
+        return done, failed
+
+    ready.put(os.getpid())
+    go.wait()
+    start = time.time()
+    for i in range(config["tasks"]):
+        slots.acquire()
+        sent = time.time()
+        done, failed = track(sent)
+        client._dispatch(METHOD, payload).callback(done, failed)
+    finished.wait()
+    end = time.time()
+    client.close()
+    results.put(dict(start=start, end=end, latencies=latencies,
+                     errors=errors))
+
+
+def run_config(config):
+    """ Runs one benchmark configuration and returns its result """
+    base = config["protocol"] == "ipc" and tempfile.mkdtemp() or None
+    address = base and os.path.join(base, "broker") or "127.0.0.1"
+    request_uri = "%s://%s:%s" % (config["protocol"], address, config["port"])
+    subscribe_uri = "%s://%s:%s" % (config["protocol"], address,
+                                    config["port"] + 1)
+    broker_options = dict(protocol=config["protocol"],
+                          address=address, codec=config["codec"],
+                          reply_port=config["port"],
+                          publish_port=config["port"] + 1)
+    node_options = dict(workers=config["workers"], codec=config["codec"],
+                        worker_mode=config["mode"],
+                        concurrency=config["worker_concurrency"])
+    broker = multiprocessing.Process(target=run_broker,
+                                     args=(broker_options,))
+    broker.start()
+    time.sleep(0.2)
+    nodes = []
+    for i in range(config["nodes"]):
+        node = multiprocessing.Process(target=run_node,
+                                       args=(request_uri, subscribe_uri,
+                                             node_options))
+        node.start()
+        nodes.append(node)
+    time.sleep(STARTUP_DELAY)
+
+    ready = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = []
+    for i in range(config["clients"]):
+        client = multiprocessing.Process(target=run_client,
+                                         args=(request_uri, subscribe_uri,
+                                               config, ready, go, results))
+        client.start()
+        clients.append(client)
+    try:
+        for client in clients:
+            ready.get()
+        go.set()
+        reports = [results.get() for client in clients]
+    finally:
+        for client in clients:
+            client.join(SHUTDOWN_TIMEOUT)
+            if client.is_alive():
+                client.terminate()
+        for node in nodes:
+            stop_process(node)
+        stop_process(broker)
+        if base:
+            shutil.rmtree(base, ignore_errors=True)
+
+    latencies = sorted(itertools.chain(*[report["latencies"]
+                                         for report in reports]))
+    errors = sum([len(report["errors"]) for report in reports])
+    seconds = (max([report["end"] for report in reports]) -
+               min([report["start"] for report in reports]))
+    result = dict((key, config[key]) for key in SWEPT + FIXED)
+    result.update(tasks=len(latencies) + errors, errors=errors,
+                  seconds=round(seconds, 3),
+                  tasks_per_sec=seconds and
+                                round(len(latencies) / seconds, 1) or 0.0)
+    for name, fraction in (("p50_ms", 0.5), ("p99_ms", 0.99)):
+        value = percentile(latencies, fraction)
+        result[name] = value is not None and round(value * 1000, 3) or None
+    return result
+
+
+# The options swept over (comma separated lists), and fixed per run
+SWEPT = ["payload", "nodes", "workers", "clients", "concurrency"]
+FIXED = ["protocol", "codec", "mode", "worker_concurrency"]
+
+def config_key(result):
+    """ Identifies a configuration, for comparing runs """
+    return tuple([result.get(key) for key in SWEPT + FIXED])
+
+def compare(base, results):
+    """ Prints each result next to the same configuration in base """
+    previous = dict((config_key(result), result)
+                    for result in base["results"])
+    print >> sys.stderr, "Compared to %s:" % (base.get("revision") or
+                                               "the base run")
+    for result in results:
+        old = previous.get(config_key(result))
+        label = " ".join(["%s=%s" % (key, result[key]) for key in SWEPT])
+        if not old:
+            print >> sys.stderr, "  %s: not in the base run" % label
+            continue
+        changes = []
+        for name in ("tasks_per_sec", "p50_ms", "p99_ms"):
+            if old[name] and result[name] is not None:
+                change = 100.0 * (result[name] - old[name]) / old[name]
+                changes.append("%s %+.1f%%" % (name, change))
+        print >> sys.stderr, "  %s: %s" % (label, ", ".join(changes))
+
+def int_list(value):
+    """ Parses a comma separated list of integers """
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    """ Runs the benchmark sweep and writes the results as JSON """
+    options = optparse.OptionParser()
+    options.add_option("--payloads", dest="payloads", default="100,10000",
+                       help="payload sizes in bytes (comma separated)")
+    options.add_option("--nodes", dest="nodes", default="1",
+                       help="node counts (comma separated)")
+    options.add_option("--workers", dest="workers", default="2",
+                       help="workers per node (comma separated)")
+    options.add_option("--clients", dest="clients", default="1,4",
+                       help="client processes (comma separated)")
+    options.add_option("--concurrency", dest="concurrency", default="1,32",
+                       help="tasks in flight per client (comma separated)")
+    options.add_option("-t", "--tasks", dest="tasks", type="int",
+                       default=1000, help="tasks per client")
+    options.add_option("--warmup", dest="warmup", type="int", default=10,
+                       help="untimed tasks per client first")
+    options.add_option("--protocol", dest="protocol", default="tcp",
+                       help="tcp|ipc")
+    options.add_option("-c", "--codec", dest="codec",
+                       default="json", help="json|msgpack")
+    options.add_option("-m", "--mode", dest="mode", default=worker.PROCESS,
+                       help="|".join(worker.MODES))
+    options.add_option("-n", "--worker-concurrency",
+                       dest="worker_concurrency", type="int", default=1,
+                       help="tasks at once per worker (thread / asyncio)")
+    options.add_option("-r", "--port", dest="port", type="int",
+                       default=7555, help="the broker's request port "
+                                          "(publishes on the next one)")
+    options.add_option("-o", "--output", dest="output", default=None,
+                       help="write the JSON results here (default stdout)")
+    options.add_option("--compare", dest="compare", default=None,
+                       help="an earlier results file to compare against")
+    options.add_option("-l", "--loglevel", dest="loglevel",
+                       default="WARNING", help="INFO|WARNING|ERROR")
+
+    opts, args = options.parse_args()
+    logging.getLogger().setLevel(getattr(logging, opts.loglevel))
+    if opts.protocol not in ("tcp", "ipc"):
+        options.error("The protocol must be tcp or ipc")
+    base = None
+    if opts.compare:
+        base = json.load(open(opts.compare))
+
+    sweep = [int_list(getattr(opts, name)) for name in
+             ("payloads", "nodes", "workers", "clients", "concurrency")]
+    results = []
+    for values in itertools.product(*sweep):
+        config = dict(zip(SWEPT, values))
+        config.update(protocol=opts.protocol, codec=opts.codec,
+                      mode=opts.mode,
+                      worker_concurrency=opts.worker_concurrency,
+                      tasks=opts.tasks, warmup=opts.warmup, port=opts.port)
+        result = run_config(config)
+        print >> sys.stderr, " ".join(["%s=%s" % (key, result[key]) for key in
+                                       SWEPT + ["tasks_per_sec", "p50_ms",
+                                                "p99_ms", "errors"]])
+        results.append(result)
+
+    report = dict(revision=revision(), python=sys.version.split()[0],
+                  tasks_per_client=opts.tasks, results=results)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print output
+    if base:
+        compare(base, results)
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,79 @@ import zerotask
 from zerotask.server import Server
 from zerotask.exceptions import JSONRPCError
 from zerotask import jsonrpc
+from zerotask import journal
+from zerotask import frames
+from zerotask import stats
+from zerotask.profiler import SamplingProfiler
+from zerotask.store import ResultStore
 import zmq
+import json
 import time
+import hashlib
 import logging
 import optparse
+import collections
 
 
 TIMEOUT = 60 # one minute
+SWEEP_INTERVAL = 1 # seconds between expiry sweeps
+MAX_TOMBSTONES = 100000 # expired task ids remembered for lookups
+PROFILE_DUMP_INTERVAL = 60 # seconds between profile dumps to disk
+REPLICATE_INTERVAL = 0.005 # seconds a change waits for more to batch
+REPLICATE_BATCH_SIZE = 1000 # records that go out without waiting
+HEARTBEAT_INTERVAL = 1 # seconds between batches, even empty ones
+FAILOVER_INTERVAL = 1 # seconds between replica checks on the primary
+REPLICA_TOPIC = "zerotask.replica"
+WORKFLOW_METHOD = "zerotask.workflow" # the method workflow tasks show as
+RESULT_REFERENCE = "$result" # {"$result": STEP} in a workflow step's params
+# what a replica answers -- everything else is the primary's job
+REPLICA_METHODS = set(["zerotask.broker.client_task_status",
+                       "zerotask.broker.client_task_statuses",
+                       "zerotask.broker.replica_promote",
+                       "zerotask.broker.stats",
+                       "zerotask.broker.profile_start",
+                       "zerotask.broker.profile_stop",
+                       "zerotask.broker.profile_report"])
+
+def cache_key(method, params):
+    """ Returns the cache key for a call. Equal params give equal keys,
+    whatever their dict order. Binary params are keyed by their digest.
+    """
+    params, attachments = frames.pack(params)
+    digests = [hashlib.sha1(memoryview(attachment).tobytes()).hexdigest()
+               for attachment in attachments]
+    return json.dumps([method, params, digests], sort_keys=True,
+                      separators=(",", ":"))
+
+def step_references(params):
+    """ Returns the names of the steps a workflow step's params use """
+    if type(params) is dict:
+        if params.keys() == [RESULT_REFERENCE]:
+            return [params[RESULT_REFERENCE]]
+        values = params.values()
+    elif type(params) in (tuple, list):
+        values = params
+    else:
+        return []
+    names = []
+    for value in values:
+        names.extend(step_references(value))
+    return names
+
+def resolve_references(params, results):
+    """ Swaps each {"$result": STEP} in params for that step's result """
+    if type(params) is dict:
+        if params.keys() == [RESULT_REFERENCE]:
+            return results[params[RESULT_REFERENCE]]
+        return dict([(key, resolve_references(value, results))
+                     for key, value in params.items()])
+    if type(params) in (tuple, list):
+        return [resolve_references(value, results) for value in params]
+    return params
+
+def step_id(workflow_id, name):
+    """ Returns the task id of a workflow step """
+    return "%s.%s" % (workflow_id, name)
 
 class Broker(Server):
     """ The broker class, which dispatches and monitors jobs """
@@ -27,7 +93,65 @@ class Broker(Server):
         self.tasks = {} # need persistance / repl. later
         self.clients = {} # need persistance / repl. later
         self.nodes = {} # need persistance / repl. later
-        Server.__init__(self)
+        self.queues = {} # method -> queued task ids, oldest first
+        self.ready_nodes = collections.deque() # node ids with credits left
+        self.capable = {} # method -> ids of nodes that can run it
+        self.generic_nodes = set() # nodes that didn't list their methods
+        # nodes silent for this long are dropped, and their tasks requeued
+        self.node_timeout = kwargs.get("node_timeout", TIMEOUT)
+        # reject tasks no connected node can run, instead of parking them
+        self.reject_unroutable = kwargs.get("reject_unroutable", False)
+        self.current_envelope = None
+        self.journal = None
+        self.held_replies = []
+        self.held_publishes = [] # (topic, message) waiting on a commit
+        self.commit_timeout = None # set while records wait for a commit
+        # Result retention. None means no limit -- results are kept
+        # in memory until they're collected.
+        self.result_ttl = kwargs.get("result_ttl")
+        self.client_timeout = kwargs.get("client_timeout")
+        self.max_memory = kwargs.get("max_memory") # bytes of results
+        self.spill_size = kwargs.get("spill_size") # spill results this big
+        self.store = None
+        if kwargs.get("spill_path"):
+            self.store = ResultStore(kwargs["spill_path"])
+        self.finished = collections.OrderedDict() # task id -> finish time
+        self.resident = collections.OrderedDict() # task id -> result size
+        self.result_bytes = 0
+        self.expired = collections.OrderedDict() # task id -> expiry time
+        # Results of pure tasks, least recently used first. Identical
+        # calls that come in while one is running wait on that one.
+        self.pure_methods = set()
+        self.cache_size = kwargs.get("cache_size", 10000)
+        self.cache_ttl = kwargs.get("cache_ttl", 300)
+        self.cache = collections.OrderedDict() # key -> (result, time)
+        self.inflight = {} # key -> id of the task running the call
+        self.followers = {} # task id -> ids of identical tasks waiting
+        self.stats = stats.Stats()
+        self.profile_rate = kwargs.get("profile_rate")
+        self.profile_path = kwargs.get("profile_path")
+        # Replication. A primary with a replicate port publishes every
+        # state change there, and replicas of it apply them and answer
+        # status queries. A replica takes over once the primary has been
+        # silent for failover_timeout seconds (0 for never).
+        self.replicate_port = kwargs.get("replicate_port")
+        self.replication_socket = None
+        self.replication_seq = 0
+        self.replication_batch = []
+        self.replicate_timeout = None # set while a batch is waiting
+        self.replicated = time.time() # when the last batch went out
+        self.primary_uri = kwargs.get("primary_uri")
+        self.primary_replicate_uri = kwargs.get("primary_replicate_uri")
+        self.replica = bool(self.primary_uri)
+        self.failover_timeout = kwargs.get("failover_timeout", 5)
+        self.replica_seq = None # None until we have a snapshot
+        self.replica_pending = [] # batches that came before the snapshot
+        self.primary_seen = time.time()
+        if self.replica and kwargs.get("journal"):
+            raise ValueError("Replicas can't have their own journal")
+        Server.__init__(self, **kwargs)
+        if kwargs.get("journal"):
+            self.load_journal(journal.Journal(kwargs["journal"], **kwargs))
 
     def setup(self):
         """ Creates the reply and publish sockets """
@@ -35,177 +159,1309 @@ class Broker(Server):
         publish_uri = base_uri % self.publish_port
         reply_uri = base_uri % self.reply_port
         self.publish_socket = self.context.socket(zmq.PUB)
-        self.reply_socket = self.context.socket(zmq.REP)
+        # ROUTER instead of REP, so requests from many clients and nodes
+        # can be interleaved instead of handled in lock-step.
+        self.reply_socket = self.context.socket(zmq.ROUTER)
+        # sends to peers that are gone fail, instead of vanishing
+        self.reply_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.publish_socket.bind(publish_uri)
         self.reply_socket.bind(reply_uri)
-        self.add_callback(self.reply_socket, self.dispatch)
+        self.add_callback(self.reply_socket, self.dispatch, routed=True)
+        if self.replica:
+            self.setup_replica()
+        else:
+            self.add_periodic(self.expire_nodes, SWEEP_INTERVAL)
+            if self.result_ttl is not None or self.client_timeout is not None:
+                self.add_periodic(self.sweep, SWEEP_INTERVAL)
+        if self.replicate_port:
+            self.replication_socket = self.context.socket(zmq.PUB)
+            self.replication_socket.bind(base_uri % self.replicate_port)
+            self.add_periodic(self.replicate, HEARTBEAT_INTERVAL)
+        if self.profile_rate:
+            self.profile_start(self.profile_rate, self.profile_path)
+        self.add_periodic(self.dump_profiles, PROFILE_DUMP_INTERVAL)
         # Adding dispatcher handlers...
         self.add_handler(self.client_connect)
         self.add_handler(self.client_disconnect)
         self.add_handler(self.client_new_task)
+        self.add_handler(self.client_new_tasks)
+        self.add_handler(self.client_new_workflow)
         self.add_handler(self.client_task_status)
+        self.add_handler(self.client_task_statuses)
         self.add_handler(self.client_task_result)
+        self.add_handler(self.client_task_parts)
         self.add_handler(self.node_connect)
+        self.add_handler(self.node_heartbeat)
         self.add_handler(self.node_disconnect)
+        self.add_handler(self.node_ready)
         self.add_handler(self.node_task_request)
         self.add_handler(self.node_task_status)
         self.add_handler(self.node_task_finished)
         self.add_handler(self.node_task_failed)
+        self.add_handler(self.node_task_results)
+        self.add_handler(self.node_stats)
+        self.add_handler(self.stats_report, "zerotask.broker.stats")
+        self.add_handler(self.profile_start)
+        self.add_handler(self.profile_stop)
+        self.add_handler(self.profile_report)
+        self.add_handler(self.replica_snapshot)
+        self.add_handler(self.replica_promote)
 
-    def dispatch(self, message):
-        """ Parse methods and send to proper places """
+    def dispatch(self, message, envelope):
+        """ Parse methods and route the reply back to the sender """
         logging.info("Receiving message %s", message)
-        result = self.dispatcher.dispatch(message)
-        logging.info("Sending message %s", result)
-        self.reply_socket.send_json(result)
+        if type(message) is dict:
+            self.stats.incr("requests", message.get("method") or "")
+        elif type(message) is list:
+            for request in message:
+                if type(request) is dict:
+                    self.stats.incr("requests", request.get("method") or "")
+        self.current_envelope = envelope
+        result = None
+        if self.replica:
+            result = self.read_only(message)
+        if result is None:
+            result = self.dispatcher.dispatch(message)
+        if result is not None and self.journal and self.journal.pending():
+            # the reply waits for the group commit, so anything we
+            # acknowledge is on disk
+            self.held_replies.append((envelope, result))
+        elif result is not None:
+            logging.info("Sending message %s", result)
+            self.reply(result, envelope)
+        if self.journal and self.journal.due():
+            self.commit()
+        if len(self.replication_batch) >= REPLICATE_BATCH_SIZE:
+            self.replicate()
+
+    def reply(self, message, envelope):
+        """ Sends a message to a peer of the reply socket. Returns False
+        if the peer has gone away.
+        """
+        self.stats.incr("messages_sent")
+        try:
+            self.send(self.reply_socket, message, envelope)
+        except zmq.ZMQError, error:
+            if error.errno != zmq.EHOSTUNREACH:
+                raise
+            logging.warning("Dropping a message to unreachable peer %r",
+                            envelope[0])
+            return False
+        return True
+
+    def teardown(self):
+        """ Flushes the journal and any profiles """
+        self.dump_profiles()
+        if self.journal:
+            self.commit()
+            self.journal.close()
+
+    # Journal
+    # -------
+
+    def load_journal(self, task_journal):
+        """ Restores tasks and clients from the journal """
+        self.journal = task_journal
+        tasks, clients = task_journal.replay()
+        self.restore(tasks.items(), clients)
+
+    def restore(self, tasks, clients):
+        """ Takes over (task id, task) pairs and clients from a journal
+        or a primary. Tasks that were assigned when the broker went down
+        are queued again.
+        """
+        for client in clients.values():
+            client["activity"] = time.time()
+        self.clients.update(clients)
+        workflows = []
+        for task_id, task in tasks:
+            self.tasks[task_id] = task
+            if task["method"] == WORKFLOW_METHOD:
+                if task["_status"] == zerotask.RUNNING:
+                    workflows.append(task_id)
+                else:
+                    self.retain_result(task_id, task)
+            elif task["_status"] in (zerotask.QUEUED, zerotask.ASSIGNED,
+                                     zerotask.RUNNING):
+                task["_status"] = zerotask.QUEUED
+                # streamed parts aren't kept -- the task starts over
+                task.pop("_parts", None)
+                # followers just run on their own after a restart
+                task.pop("_follows", None)
+                if task.get("_key") is not None:
+                    self.inflight.setdefault(task["_key"], task_id)
+                self.enqueue(task_id, task)
+            elif not task.get("_workflow"):
+                self.retain_result(task_id, task)
+        for workflow_id in workflows:
+            # queue any steps whose inputs finished just before we stopped
+            self.advance_workflow(workflow_id)
+
+    def record(self, kind, key, data=None):
+        """ Journals a state change (if there is a journal), and queues
+        it for the replicas (if there are any)
+        """
+        if self.journal:
+            self.journal.append(kind, key, data)
+            if self.commit_timeout is None:
+                self.commit_timeout = self.add_timeout(
+                    self.commit, self.journal.sync_interval)
+        if self.replication_socket is not None:
+            if type(data) is dict:
+                data = dict(data) # as it is now, not when it's sent
+            self.replication_batch.append([kind, key, data])
+            if self.replicate_timeout is None:
+                self.replicate_timeout = self.add_timeout(
+                    self.replicate, REPLICATE_INTERVAL)
+
+    def commit(self):
+        """ Group-commits the journal, then sends the replies and
+        notifications that were waiting on it.
+        """
+        if self.commit_timeout is not None:
+            self.remove_timeout(self.commit_timeout)
+            self.commit_timeout = None
+        self.journal.commit()
+        held_replies, self.held_replies = self.held_replies, []
+        for envelope, result in held_replies:
+            logging.info("Sending message %s", result)
+            self.reply(result, envelope)
+        held_publishes, self.held_publishes = self.held_publishes, []
+        for topic, message in held_publishes:
+            self.publish(topic, message)
+        if self.journal.needs_compaction():
+            self.journal.compact(self.tasks, self.clients)
     
+    # Replication
+    # -----------
+
+    def replicate(self):
+        """ Publishes the state changes since the last batch to the
+        replicas. An empty batch goes out every HEARTBEAT_INTERVAL as a
+        heartbeat, unless batches went out since the last one.
+        """
+        if self.replicate_timeout is not None:
+            self.remove_timeout(self.replicate_timeout)
+            self.replicate_timeout = None
+        now = time.time()
+        if not self.replication_batch and \
+                now - self.replicated < HEARTBEAT_INTERVAL / 2.0:
+            return
+        self.replication_seq += 1
+        records, self.replication_batch = self.replication_batch, []
+        params = dict(seq=self.replication_seq, records=records)
+        message = jsonrpc.request("zerotask.replica.records", params,
+                                  id=None)
+        self.send(self.replication_socket, message, [REPLICA_TOPIC])
+        self.replicated = now
+
+    def replica_snapshot(self):
+        """ Returns the whole state for a new (or lagging) replica, and
+        the replication sequence number it's current as of
+        """
+        if self.replication_socket is None:
+            raise JSONRPCError(jsonrpc.INVALID_REQUEST,
+                               "Replication is off (no replicate port).")
+        self.replicate() # so the snapshot lines up with a batch
+        tasks = []
+        for task_id, task in self.tasks.iteritems():
+            if task.get("_spilled"):
+                task = dict(task, result=self.store.get(task_id))
+                del task["_spilled"]
+            tasks.append([task_id, task])
+        return dict(seq=self.replication_seq, tasks=tasks,
+                    clients=self.clients)
+
+    def setup_replica(self):
+        """ Subscribes to the primary's state changes and asks it for
+        a snapshot to start from
+        """
+        logging.info("Replicating %s", self.primary_uri)
+        self.replica_socket = self.context.socket(zmq.SUB)
+        self.replica_socket.setsockopt(zmq.RCVHWM, 0)
+        self.replica_socket.connect(self.primary_replicate_uri)
+        self.replica_socket.setsockopt(zmq.SUBSCRIBE, REPLICA_TOPIC)
+        self.add_callback(self.replica_socket, self.replica_records)
+        self.primary_socket = self.context.socket(zmq.DEALER)
+        self.primary_socket.connect(self.primary_uri)
+        self.add_callback(self.primary_socket, self.replica_loaded)
+        if self.failover_timeout:
+            self.add_periodic(self.check_primary, FAILOVER_INTERVAL)
+        self.request_snapshot()
+
+    def request_snapshot(self):
+        """ Asks the primary for its state. Batches that come in
+        meanwhile are held until it arrives.
+        """
+        self.replica_seq = None
+        self.replica_pending = []
+        request = jsonrpc.request("zerotask.broker.replica_snapshot", [])
+        self.send(self.primary_socket, request, [""])
+
+    def replica_loaded(self, response):
+        """ Starts over from the primary's snapshot """
+        if not self.replica:
+            return # promoted while it was on the way
+        if response.has_key("error"):
+            logging.error("Couldn't get a snapshot: %s", response["error"])
+            return
+        snapshot = response["result"]
+        self.tasks.clear()
+        self.tasks.update([(task_id, task)
+                           for task_id, task in snapshot["tasks"]])
+        self.clients.clear()
+        self.clients.update(snapshot["clients"])
+        self.replica_seq = snapshot["seq"]
+        logging.info("Loaded a snapshot of %d tasks at %d", len(self.tasks),
+                     self.replica_seq)
+        pending, self.replica_pending = self.replica_pending, []
+        for batch in pending:
+            self.apply_batch(batch)
+
+    def replica_records(self, message):
+        """ Handles a batch of state changes from the primary """
+        self.primary_seen = time.time()
+        if not self.replica:
+            return
+        batch = message.get("params", {})
+        if self.replica_seq is None:
+            self.replica_pending.append(batch)
+            return
+        self.apply_batch(batch)
+
+    def apply_batch(self, batch):
+        """ Applies a batch, unless we already have it. A missing batch
+        means starting over from a new snapshot.
+        """
+        if self.replica_seq is None:
+            return # lost track -- waiting on a snapshot
+        if batch["seq"] <= self.replica_seq:
+            return
+        if batch["seq"] != self.replica_seq + 1:
+            logging.warning("Missed replication batches %d to %d",
+                            self.replica_seq + 1, batch["seq"] - 1)
+            self.request_snapshot()
+            return
+        for record in batch["records"]:
+            journal.apply_record(record, self.tasks, self.clients)
+        self.replica_seq = batch["seq"]
+
+    def read_only(self, message):
+        """ Returns errors for a message a replica can't answer, or
+        None if it only asks for things a replica knows. Batches with
+        any writes in them are turned down whole.
+        """
+        requests = type(message) is list and message or [message]
+        writes = [request for request in requests
+                  if type(request) is not dict or
+                  request.get("method") not in REPLICA_METHODS]
+        if not writes:
+            return None
+        errors = [jsonrpc.error(jsonrpc.READ_ONLY,
+                                type(request) is dict and
+                                request.get("id") or None)
+                  for request in writes]
+        return type(message) is list and errors or errors[0]
+
+    def check_primary(self):
+        """ Takes over if the primary has gone quiet """
+        if not self.replica or self.replica_seq is None:
+            return # nothing to take over with yet
+        silent = time.time() - self.primary_seen
+        if silent > self.failover_timeout:
+            logging.warning("Primary silent for %.1f seconds -- taking "
+                            "over", silent)
+            self.replica_promote()
+
+    def replica_promote(self):
+        """ Turns a replica into a primary, with the state it has """
+        if not self.replica:
+            return True
+        self.replica = False
+        self.remove_callback(self.replica_socket)
+        self.remove_callback(self.primary_socket)
+        tasks = sorted(self.tasks.items(),
+                       key=lambda item: item[1].get("_queued", 0))
+        clients = dict(self.clients)
+        self.tasks.clear()
+        self.clients.clear()
+        self.restore(tasks, clients)
+        self.add_periodic(self.expire_nodes, SWEEP_INTERVAL)
+        if self.result_ttl is not None or self.client_timeout is not None:
+            self.add_periodic(self.sweep, SWEEP_INTERVAL)
+        logging.warning("Promoted to primary with %d tasks", len(tasks))
+        return True
+
+    # Result retention
+    # ----------------
+
+    def retain_result(self, task_id, task):
+        """ Tracks a finished task for expiry and the memory budget,
+        spilling big results straight to disk.
+        """
+        self.finished[task_id] = time.time()
+        old_size = self.resident.pop(task_id, None)
+        if old_size:
+            # retained before, so don't count it twice
+            self.result_bytes -= old_size
+        if self.max_memory is None and self.spill_size is None:
+            return
+        size = self.result_size(task)
+        if self.store and self.spill_size is not None and \
+                size >= self.spill_size:
+            self.spill(task_id, task)
+            return
+        self.resident[task_id] = size
+        self.result_bytes += size
+        while self.max_memory is not None and self.resident and \
+                self.result_bytes > self.max_memory:
+            # oldest results go first
+            old_id, old_size = self.resident.popitem(last=False)
+            self.result_bytes -= old_size
+            old_task = self.tasks[old_id]
+            if self.store and old_task.has_key("result"):
+                self.spill(old_id, old_task)
+            else:
+                self.expire(old_id)
+
+    def result_size(self, task):
+        """ Estimates the bytes a task's result (or error) takes """
+        data, attachments = frames.pack(task.get("result", task.get("error")))
+        size = len(self.codec.encode(data))
+        for attachment in attachments:
+            size += len(attachment)
+        return size
+
+    def spill(self, task_id, task):
+        """ Moves a result from memory to the disk store """
+        if not task.has_key("result"):
+            return
+        self.store.put(task_id, task.pop("result"))
+        task["_spilled"] = True
+        logging.info("Spilled result for task %s", task_id)
+
+    def drop_task(self, task_id):
+        """ Forgets a task, its retention entries and any spilled result """
+        task = self.tasks.pop(task_id, None)
+        if task and task.get("_key") is not None:
+            # identical calls were waiting on this one
+            self.promote_follower(task_id, task["_key"])
+        self.finished.pop(task_id, None)
+        size = self.resident.pop(task_id, None)
+        if size:
+            self.result_bytes -= size
+        if task and task.get("_spilled") and self.store:
+            self.store.delete(task_id)
+        self.record(journal.COLLECTED, task_id)
+        return task
+
+    def expire(self, task_id):
+        """ Drops an uncollected task, remembering that it expired """
+        self.drop_task(task_id)
+        self.expired[task_id] = time.time()
+        if len(self.expired) > MAX_TOMBSTONES:
+            self.expired.popitem(last=False)
+        logging.info("Expired task %s", task_id)
+
+    def drop_client(self, client_id):
+        """ Forgets a client and every task it left behind """
+        del self.clients[client_id]
+        self.record(journal.CLIENT_GONE, client_id)
+        prefix = "%s-" % client_id
+        for task_id in [key for key in self.tasks if key.startswith(prefix)]:
+            self.drop_task(task_id)
+
+    def sweep(self):
+        """ Expires old results and forgets idle clients. A client
+        waiting on work that hasn't finished isn't idle, however quiet it
+        is -- it's dropped once its last task finishes and it still
+        doesn't come back for the results.
+        """
+        now = time.time()
+        if self.result_ttl is not None:
+            while self.finished:
+                task_id, finished = next(self.finished.iteritems())
+                if finished + self.result_ttl > now:
+                    break
+                self.expire(task_id)
+        if self.client_timeout is None:
+            return
+        idle = [client_id for client_id, client in self.clients.iteritems()
+                if client["activity"] + self.client_timeout < now]
+        if not idle:
+            return
+        busy = set([task_id.split("-", 1)[0]
+                    for task_id, task in self.tasks.iteritems()
+                    if task["_status"] not in (zerotask.FINISHED,
+                                               zerotask.FAILED)])
+        for client_id in idle:
+            if client_id not in busy:
+                logging.info("Dropping idle client %s", client_id)
+                self.drop_client(client_id)
+
+    def check_client(self, client_id):
+        """ Raises an error if the client id is unknown, and marks the
+        client as active
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
+        client["activity"] = time.time()
+
+    def check_task(self, task_id):
+        """ Returns a task, or raises an error for unknown and
+        expired task ids
+        """
+        task = self.tasks.get(task_id)
+        if not task:
+            if self.expired.has_key(task_id):
+                raise JSONRPCError(jsonrpc.RESULT_EXPIRED)
+            raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
+        return task
+
+    # Pure task cache
+    # ---------------
+
+    def cache_lookup(self, key):
+        """ Returns the (result, time) cached for a call, if it's fresh """
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            return None
+        if self.cache_ttl is not None and \
+                entry[1] + self.cache_ttl < time.time():
+            return None
+        self.cache[key] = entry # most recently used
+        return entry
+
+    def cache_store(self, key, result):
+        """ Caches a pure task's result, dropping the least recently
+        used results over the size limit
+        """
+        self.cache.pop(key, None)
+        self.cache[key] = (result, time.time())
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def promote_follower(self, task_id, key):
+        """ Queues the first task waiting on a dropped task in its place """
+        if self.inflight.get(key) == task_id:
+            del self.inflight[key]
+        followers = [follower_id for follower_id
+                     in self.followers.pop(task_id, [])
+                     if self.tasks.has_key(follower_id)]
+        if not followers:
+            return
+        primary_id = followers.pop(0)
+        primary = self.tasks[primary_id]
+        primary.pop("_follows", None)
+        primary["_key"] = key
+        self.inflight[key] = primary_id
+        for follower_id in followers:
+            self.tasks[follower_id]["_follows"] = primary_id
+        if followers:
+            self.followers[primary_id] = followers
+        self.enqueue(primary_id, primary)
+        self.assign_tasks()
+
     # Client methods
     # --------------
 
     def client_connect(self, client_id=None):
         """ Checks if a client id is valid and unused. """
         client_id = client_id or jsonrpc.get_random_id()
+        if "-" in client_id:
+            # the dash separates client and task ids in topics
+            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
         client = self.clients.get(client_id)
         if not client:
             client = {}
             self.clients[client_id] = client
+            self.record(journal.CLIENT, client_id, client)
         client["activity"] = time.time()
         return client_id
 
     def client_disconnect(self, client_id):
-        """ Deletes client from clients list """
-        client = self.clients.get(client_id)
-        if not client:
-            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
-        del self.clients[client_id]
+        """ Deletes client from clients list, along with its tasks """
+        self.check_client(client_id)
+        self.drop_client(client_id)
         return True
 
-    def client_new_task(self, client_id, method, params, task_id=None):
+    def client_new_task(self, client_id, method, params, task_id=None,
+                        chunk=False):
         """ Stores a CLIENTID-TASKID task structure and returns
         the task id to the client.
-        It will create a task id if one is not provided.
+        It will create a task id if one is not provided. A chunk task's
+        params are a list of params, one per call to the method.
         """
-        if not self.clients.has_key(client_id):
-            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
+        self.check_client(client_id)
+        full_id = self.queue_task(client_id, method, params, task_id, chunk)
+        self.assign_tasks()
+        return full_id
+
+    def client_new_tasks(self, client_id, tasks):
+        """ Stores a list of {"method", "params", ["task_id"], ["chunk"]}
+        tasks and returns their ids in order. The tasks are handed out in one
+        pass, so each node gets a single batch.
+        """
+        self.check_client(client_id)
+        if type(tasks) not in (tuple, list):
+            raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+        # check every task first, so a bad one doesn't leave half a batch
+        task_ids = []
+        for task in tasks:
+            if type(task) is not dict or not task.get("method"):
+                raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+            if task.get("chunk") and \
+                    type(task.get("params", [])) not in (tuple, list):
+                raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+            task_id = task.get("task_id") or jsonrpc.get_random_id()
+            full_id = "%s-%s" % (client_id, task_id)
+            if self.tasks.has_key(full_id) or full_id in task_ids:
+                raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
+            if self.reject_unroutable and not self.generic_nodes and \
+                    not self.capable.get(task["method"]):
+                raise JSONRPCError(jsonrpc.METHOD_NOT_FOUND)
+            task_ids.append(full_id)
+        full_ids = []
+        for task, full_id in zip(tasks, task_ids):
+            task_id = full_id[len(client_id)+1:]
+            full_ids.append(self.queue_task(client_id, task["method"],
+                                            task.get("params", []),
+                                            task_id,
+                                            task.get("chunk", False)))
+        self.assign_tasks()
+        return full_ids
+
+    def queue_task(self, client_id, method, params, task_id=None,
+                   chunk=False, workflow=None):
+        """ Stores a new task and queues it (without handing it out) """
         task_id = task_id or jsonrpc.get_random_id()
         full_id = "%s-%s" % (client_id, task_id)
         if self.tasks.has_key(full_id):
             raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
-        task = self.tasks.get(full_id)
-        announce_params = dict(method=method, task_id=full_id)
-        announce_method = "zerotask.node.task_ready"
-        pub_message = jsonrpc.request(method=announce_method,
-                                      params=announce_params,
-                                      id=None) # notification
-        self.publish_socket.send_json(pub_message)
+        if not self.capable.get(method) and not self.generic_nodes:
+            if self.reject_unroutable:
+                raise JSONRPCError(jsonrpc.METHOD_NOT_FOUND)
+            logging.info("No node can run %s yet -- parking task.", method)
         task = dict(method=method,
                     params=params,
                     _status=zerotask.QUEUED,
+                    _queued=time.time(),
                     id=task_id)
+        if chunk:
+            if type(params) not in (tuple, list):
+                raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+            task["chunk"] = True
+        if workflow:
+            task["_workflow"] = workflow
+        key = None
+        if self.cache_size and method in self.pure_methods and not chunk:
+            try:
+                key = cache_key(method, params)
+            except (TypeError, ValueError):
+                # params JSON can't key (like non UTF-8 strings) just
+                # aren't cached
+                logging.info("Can't cache a call to %s", method)
         self.tasks[full_id] = task
+        self.stats.incr("tasks_submitted", method)
+        if key is not None:
+            entry = self.cache_lookup(key)
+            if entry is not None:
+                # answered from the cache, no node needed
+                self.stats.incr("cache_hits", method)
+                self.record(journal.QUEUED, full_id, task)
+                for done_id in self.complete_task(full_id,
+                                                  dict(result=entry[0])):
+                    self.announce_result(done_id)
+                return full_id
+        if key is not None and self.inflight.has_key(key):
+            # the same call is already running -- share its result
+            self.stats.incr("shared_calls", method)
+            task["_follows"] = self.inflight[key]
+            self.followers.setdefault(self.inflight[key], []).append(full_id)
+        else:
+            if key is not None:
+                task["_key"] = key
+                self.inflight[key] = full_id
+            self.enqueue(full_id, task)
+        self.record(journal.QUEUED, full_id, task)
         return full_id
 
     def client_task_status(self, client_id, task_id):
         """ Retrieve a task status, if valid. """
-        if not self.clients.has_key(client_id):
-            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
-        task = self.tasks.get(task_id)
-        if not task:
-            raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
+        self.check_client(client_id)
+        task = self.check_task(task_id)
         return task["_status"]
 
+    def client_task_statuses(self, client_id, task_ids):
+        """ Returns {task id: status} for several tasks. Unknown (or
+        expired) tasks are left out.
+        """
+        self.check_client(client_id)
+        statuses = {}
+        for task_id in task_ids:
+            task = self.tasks.get(task_id)
+            if task:
+                statuses[task_id] = task["_status"]
+        return statuses
+
+    def client_task_parts(self, client_id, task_id):
+        """ Returns {"status", "parts", ["progress"]} for a task, handing
+        over (and forgetting) the parts it has streamed so far. The task
+        can then stream that many more.
+        """
+        self.check_client(client_id)
+        task = self.check_task(task_id)
+        parts = task.pop("_parts", [])
+        if parts and task["_status"] == zerotask.RUNNING:
+            self.ack_parts(task_id, task, len(parts))
+        response = dict(status=task["_status"], parts=parts)
+        if task.has_key("_progress"):
+            response["progress"] = task["_progress"]
+        return response
+
     def client_task_result(self, client_id, task_id):
         """ Retrieve a result and drop it from store """
-        if not self.clients.has_key(client_id):
-            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
-        task = self.tasks.get(task_id)
-        if not task:
+        self.check_client(client_id)
+        task = self.check_task(task_id)
+        if task.get("_workflow"):
+            # step results belong to the workflow
             raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
         if not task["_status"] in (zerotask.FINISHED, zerotask.FAILED):
             raise JSONRPCError(jsonrpc.TASK_NOT_COMPLETE)
-        result = task["result"]
-        del self.tasks[task_id]
-        return result
+        if task.get("_spilled"):
+            if not self.store:
+                # spilled before a restart without the spill path
+                logging.warning("No spill path to read result %s from",
+                                task_id)
+                self.expire(task_id)
+                raise JSONRPCError(jsonrpc.RESULT_EXPIRED)
+            task["result"] = self.store.get(task_id)
+        finished = self.finished.get(task_id)
+        if finished is not None:
+            self.stats.observe("collect_delay_seconds", task["method"],
+                               time.time() - finished)
+        self.drop_task(task_id)
+        if task["_status"] == zerotask.FAILED:
+            error = task["error"]
+            raise JSONRPCError(error["code"], error.get("message"))
+        return task["result"]
+
+    # Workflows
+    # ---------
+
+    def client_new_workflow(self, client_id, steps, outputs=None,
+                            task_id=None):
+        """ Stores a workflow -- {name: {"method", "params"}} steps, where
+        params can use {"$result": STEP} for another step's result -- and
+        returns its task id. Each step is queued once the steps it uses
+        are done, so results go from step to step without the client.
+        The result is {step: result} for the outputs (by default, the
+        steps nothing uses), or just the one result if outputs is a step
+        name. The first step error fails the whole workflow.
+        """
+        self.check_client(client_id)
+        self.check_workflow(steps, outputs)
+        task_id = task_id or jsonrpc.get_random_id()
+        full_id = "%s-%s" % (client_id, task_id)
+        if self.tasks.has_key(full_id):
+            raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
+        if outputs is None:
+            used = set()
+            for step in steps.values():
+                used.update(step_references(step.get("params", [])))
+            outputs = sorted([name for name in steps if name not in used])
+        workflow = dict(method=WORKFLOW_METHOD,
+                        params=dict(steps=steps, outputs=outputs),
+                        _status=zerotask.RUNNING,
+                        _queued=time.time(),
+                        id=task_id)
+        self.tasks[full_id] = workflow
+        self.stats.incr("tasks_submitted", WORKFLOW_METHOD)
+        self.record(journal.QUEUED, full_id, workflow)
+        for done_id in self.advance_workflow(full_id):
+            self.announce_result(done_id)
+        return full_id
+
+    def check_workflow(self, steps, outputs):
+        """ Raises an error for malformed steps, references to unknown
+        steps, cycles and unknown outputs
+        """
+        if type(steps) is not dict or not steps:
+            raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+        uses = {} # step -> the steps it uses
+        for name, step in steps.items():
+            if type(step) is not dict or not step.get("method") or \
+                    type(step.get("params", [])) not in (tuple, list, dict):
+                raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+            if self.reject_unroutable and not self.generic_nodes and \
+                    not self.capable.get(step["method"]):
+                raise JSONRPCError(jsonrpc.METHOD_NOT_FOUND)
+            references = step_references(step.get("params", []))
+            for reference in references:
+                if not isinstance(reference, basestring) or \
+                        not steps.has_key(reference):
+                    raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+            uses[name] = set(references)
+        # peel off steps with nothing left to wait on -- a cycle never
+        # gets there
+        while uses:
+            ready = [name for name, used in uses.items()
+                     if not used.intersection(uses)]
+            if not ready:
+                raise JSONRPCError(jsonrpc.INVALID_PARAMETERS,
+                                   "Workflow steps can't form a cycle.")
+            for name in ready:
+                del uses[name]
+        if outputs is None:
+            return
+        if isinstance(outputs, basestring):
+            outputs = [outputs]
+        if type(outputs) not in (tuple, list) or \
+                [name for name in outputs if not steps.has_key(name)]:
+            raise JSONRPCError(jsonrpc.INVALID_PARAMETERS)
+
+    def advance_workflow(self, workflow_id):
+        """ Queues the workflow steps whose inputs are ready, and
+        completes the workflow once every step is done (or one failed).
+        Returns the ids of the tasks completed.
+        """
+        workflow = self.tasks.get(workflow_id)
+        if not workflow or workflow["_status"] != zerotask.RUNNING:
+            return []
+        steps = workflow["params"]["steps"]
+        results = {}
+        for name in sorted(steps):
+            step = self.tasks.get(step_id(workflow_id, name))
+            if step is None:
+                continue
+            if step["_status"] == zerotask.FAILED:
+                error = dict(step["error"])
+                error["message"] = "Step %s failed: %s" % (
+                    name, error.get("message"))
+                return self.finish_workflow(workflow_id, dict(error=error))
+            if step["_status"] == zerotask.FINISHED:
+                results[name] = step.get("result")
+        if len(results) == len(steps):
+            outputs = workflow["params"]["outputs"]
+            if isinstance(outputs, basestring):
+                result = results[outputs]
+            else:
+                result = dict([(name, results[name]) for name in outputs])
+            return self.finish_workflow(workflow_id, dict(result=result))
+        client_id, task_id = workflow_id.split("-", 1)
+        queued = False
+        for name in sorted(steps):
+            if self.tasks.has_key(step_id(workflow_id, name)):
+                continue # running, or done
+            params = steps[name].get("params", [])
+            if [used for used in step_references(params)
+                    if not results.has_key(used)]:
+                continue # still waiting on a step
+            self.queue_task(client_id, steps[name]["method"],
+                            resolve_references(params, results),
+                            "%s.%s" % (task_id, name),
+                            steps[name].get("chunk", False), workflow_id)
+            if workflow["_status"] != zerotask.RUNNING:
+                return [] # finished from the cache, and announced
+            queued = True
+        if queued:
+            self.assign_tasks()
+        return []
+
+    def finish_workflow(self, workflow_id, report):
+        """ Drops the workflow's steps and completes it with the report """
+        for name in self.tasks[workflow_id]["params"]["steps"]:
+            if self.tasks.has_key(step_id(workflow_id, name)):
+                self.drop_task(step_id(workflow_id, name))
+        return self.complete_task(workflow_id, report)
 
     # Node methods
     # ------------
 
-    def node_connect(self, node_id=None):
-        """ Adds a node to the node list, and returns node id """
+    def node_connect(self, node_id=None, methods=None, pure=None):
+        """ Adds a node to the node list, and returns node id.
+        Tasks are only offered to nodes that listed their method, or
+        that didn't send a method list at all. Results of the methods
+        listed as pure are cached.
+        """
+        self.pure_methods.update(pure or [])
         node_id = node_id or jsonrpc.get_random_id()
         node = self.nodes.get(node_id)
-        if node and node['activity'] > time.time() - TIMEOUT:
+        if node and node['activity'] > time.time() - self.node_timeout:
             raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
         if not node:
             node = {}
             self.nodes[node_id] = node
+        self.unindex_node(node_id)
+        node["methods"] = methods
+        if methods is None:
+            self.generic_nodes.add(node_id)
+        else:
+            for method in methods:
+                self.capable.setdefault(method, set()).add(node_id)
         self.nodes[node_id]['activity'] = time.time()
         return node_id
 
+    def unindex_node(self, node_id):
+        """ Removes a node from the method index """
+        self.generic_nodes.discard(node_id)
+        node = self.nodes.get(node_id)
+        for method in (node and node.get("methods")) or []:
+            capable = self.capable.get(method)
+            if capable:
+                capable.discard(node_id)
+                if not capable:
+                    del self.capable[method]
+
+    def check_node(self, node_id):
+        """ Returns a node, or raises an error if the node id is
+        unknown, and marks the node as active
+        """
+        node = self.nodes.get(node_id)
+        if node is None:
+            raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
+        node["activity"] = time.time()
+        return node
+
+    def expire_nodes(self):
+        """ Disconnects nodes that have gone quiet, so their credits
+        are dropped and their tasks go to other nodes
+        """
+        now = time.time()
+        for node_id, node in self.nodes.items():
+            if not self.nodes.has_key(node_id):
+                continue # an unreachable node, dropped on the way
+            if node["activity"] + self.node_timeout < now:
+                logging.warning("Node %s went quiet -- requeueing its "
+                                "tasks", node_id)
+                self.node_disconnect(node_id)
+
+    def node_heartbeat(self, node_id):
+        """ Marks a node as alive """
+        self.check_node(node_id)
+        return True
+
     def node_disconnect(self, node_id):
-        """ Deletes a node entry from the node list """
+        """ Deletes a node entry from the node list and requeues
+        any tasks that were assigned to it.
+        """
         if not self.nodes.has_key(node_id):
             raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
+        self.unindex_node(node_id)
         del self.nodes[node_id]
+        if node_id in self.ready_nodes:
+            self.ready_nodes.remove(node_id)
+        for task_id, task in self.tasks.items():
+            if task["_status"] in (zerotask.ASSIGNED, zerotask.RUNNING) \
+                    and task.get("_node") == node_id \
+                    and task["method"] != WORKFLOW_METHOD:
+                task["_status"] = zerotask.QUEUED
+                task.pop("_parts", None)
+                self.enqueue(task_id, task, front=True)
+                self.record(journal.REQUEUED, task_id)
+        self.assign_tasks()
+        return True
+
+    def node_ready(self, node_id, credits=1):
+        """ Adds credits (free worker slots) for a node, and hands
+        it any queued tasks it now has room for.
+        """
+        node = self.check_node(node_id)
+        # tasks are pushed back to whichever socket sent the credits
+        node["envelope"] = self.current_envelope
+        if not node.get("credits"):
+            self.ready_nodes.append(node_id)
+        node["credits"] = node.get("credits", 0) + credits
+        self.assign_tasks()
         return True
 
     def node_task_request(self, node_id, task_id):
         """ Receive a task request from a node """
-        if not self.nodes.has_key(node_id):
-            raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
+        self.check_node(node_id)
         task = self.tasks.get(task_id)
         if not task:
             raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
         if task and task["_status"] == zerotask.QUEUED:
             result = task
-            task["_status"] = zerotask.ASSIGNED
-            task["_node"] = node_id
-            logging.info("Assigned task %s to node %s", task_id, node_id)
+            self.mark_assigned(task_id, task, node_id)
         else:
             # Task has already been assigned to a node
             result = None
         return result
 
-    def node_task_status(self, node_id, task_id, status, **kwargs):
-        """ Updates the task status """
-        pass
+    def enqueue(self, task_id, task, front=False):
+        """ Queues a task under its method """
+        queue = self.queues.get(task["method"])
+        if queue is None:
+            queue = self.queues[task["method"]] = collections.deque()
+        task.setdefault("_queued", time.time())
+        if front:
+            queue.appendleft(task_id)
+        else:
+            queue.append(task_id)
+
+    def queue_head(self, method):
+        """ Returns the oldest queued task id for a method, dropping
+        tasks that were claimed (node_task_request) or collected since
+        """
+        queue = self.queues.get(method)
+        while queue:
+            task = self.tasks.get(queue[0])
+            if task and task["_status"] == zerotask.QUEUED:
+                return queue[0]
+            queue.popleft()
+        self.queues.pop(method, None)
+        return None
+
+    def next_task(self, node):
+        """ Pops the oldest queued task the node can run, if any """
+        methods = node.get("methods")
+        if methods is None:
+            methods = self.queues.keys()
+        oldest_method = None
+        oldest_time = None
+        for method in methods:
+            task_id = self.queue_head(method)
+            if task_id is None:
+                continue
+            queued = self.tasks[task_id]["_queued"]
+            if oldest_method is None or queued < oldest_time:
+                oldest_method = method
+                oldest_time = queued
+        if oldest_method is None:
+            return None
+        return self.queues[oldest_method].popleft()
+
+    def assign_tasks(self):
+        """ Hands queued tasks to nodes with credits, round robin.
+        Each node gets everything assigned in this pass as one batch.
+        """
+        assignments = {}
+        idle = 0 # nodes in a row with nothing they can run
+        while self.queues and idle < len(self.ready_nodes):
+            node_id = self.ready_nodes[0]
+            node = self.nodes.get(node_id)
+            if not node or node.get("credits", 0) < 1:
+                self.ready_nodes.popleft()
+                continue
+            task_id = self.next_task(node)
+            if task_id is None:
+                idle += 1
+                self.ready_nodes.rotate(-1)
+                continue
+            idle = 0
+            task = self.tasks[task_id]
+            assignments.setdefault(node_id, []).append(task_id)
+            self.mark_assigned(task_id, task, node_id)
+            node["credits"] -= 1
+            if node["credits"]:
+                self.ready_nodes.rotate(-1)
+            else:
+                self.ready_nodes.popleft()
+        unreachable = []
+        for node_id, task_ids in assignments.items():
+            if not self.send_tasks(self.nodes[node_id], task_ids):
+                unreachable.append(node_id)
+        for node_id in unreachable:
+            self.node_disconnect(node_id)
+
+    def mark_assigned(self, task_id, task, node_id):
+        """ Marks a task as handed to a node """
+        now = time.time()
+        self.stats.observe("queue_wait_seconds", task["method"],
+                           now - task["_queued"])
+        task["_status"] = zerotask.ASSIGNED
+        task["_node"] = node_id
+        task["_assigned"] = now
+        self.record(journal.ASSIGNED, task_id, node_id)
+        logging.info("Assigned task %s to node %s", task_id, node_id)
+
+    def send_tasks(self, node, task_ids):
+        """ Pushes tasks directly to a node's task socket. Returns False
+        if the node is gone.
+        """
+        assign_method = "zerotask.node.task_assigned"
+        messages = []
+        for task_id in task_ids:
+            task = self.tasks[task_id]
+            assign_params = dict(task_id=task_id,
+                                 method=task["method"],
+                                 params=task["params"])
+            if task.get("chunk"):
+                assign_params["chunk"] = True
+            messages.append(jsonrpc.request(method=assign_method,
+                                            params=assign_params,
+                                            id=None)) # notification
+        if len(messages) == 1:
+            messages = messages[0]
+        return self.reply(messages, node["envelope"])
+
+    def node_task_status(self, node_id, task_id, status, progress=None,
+                         parts=None):
+        """ Marks a task as running, and passes on any progress or parts
+        it reported. Parts wait here until the client takes them (at most
+        a window of them, as the worker waits for acks), except a workflow
+        step's, which become its result.
+        """
+        self.check_node(node_id)
+        if not self.assigned_to(task_id, node_id):
+            return False # finished (or requeued) already
+        task = self.tasks[task_id]
+        if task["_status"] == zerotask.ASSIGNED:
+            task["_status"] = zerotask.RUNNING
+            if task.get("_assigned"):
+                self.stats.observe("start_wait_seconds", task["method"],
+                                   time.time() - task["_assigned"])
+        if progress is None and not parts:
+            return True
+        if progress is not None:
+            task["_progress"] = progress
+        if parts:
+            task.setdefault("_parts", []).extend(parts)
+            self.stats.incr("parts_streamed", task["method"], len(parts))
+            if task.get("_workflow"):
+                self.ack_parts(task_id, task, len(parts))
+                return True
+        status_method = "zerotask.client.task_status"
+        status_params = dict(task_id=task_id, status=zerotask.RUNNING,
+                             parts=len(task.get("_parts", [])))
+        if task.has_key("_progress"):
+            status_params["progress"] = task["_progress"]
+        self.publish(task_id, jsonrpc.request(method=status_method,
+                                              params=status_params,
+                                              id=None)) # notification
+        return True
+
+    def ack_parts(self, task_id, task, count):
+        """ Tells the node running a task that count more of its parts
+        can be sent
+        """
+        node = self.nodes.get(task.get("_node"))
+        if not node or not node.get("envelope"):
+            return
+        acked = jsonrpc.request(method="zerotask.node.task_parts_acked",
+                                params=dict(task_id=task_id, count=count),
+                                id=None) # notification
+        if not self.reply(acked, node["envelope"]):
+            self.node_disconnect(task["_node"])
+
+    def assigned_to(self, task_id, node_id):
+        """ Returns True if the task is assigned to (or running on) the
+        node. Reports for anything else are stale -- the task finished,
+        or was requeued and handed to another node -- and are ignored.
+        """
+        task = self.tasks.get(task_id)
+        return bool(task) and task.get("_node") == node_id and \
+            task["_status"] in (zerotask.ASSIGNED, zerotask.RUNNING)
+
+    def check_result(self, task_id, node_id):
+        """ Returns True if a node's result for a task should be kept """
+        if self.assigned_to(task_id, node_id):
+            return True
+        logging.warning("Ignoring a result for task %s from node %s, "
+                        "which isn't running it", task_id, node_id)
+        return False
 
     def node_task_finished(self, node_id, task_id, result):
         """ Run task finished process """
-        if not self.nodes.has_key(node_id):
-            raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
+        self.check_node(node_id)
         if not self.tasks.has_key(task_id):
             raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
-        task = self.tasks[task_id]
-        task["result"] = result
-        task["_status"] = zerotask.FINISHED
-        announce_method = "zerotask.client.task_result_ready"
-        announce_params = dict(task_id=task_id)
-        pub_message = jsonrpc.request(method=announce_method,
-                                      params=announce_params,
-                                      id=None) # notification
-        logging.info("Publishing message %s", pub_message)
-        self.publish_socket.send_json(pub_message)
+        if not self.check_result(task_id, node_id):
+            return False
+        for done_id in self.complete_task(task_id, dict(result=result)):
+            self.announce_result(done_id)
         return True
 
     def node_task_failed(self, node_id, task_id, error):
         """ Saves task error state and announces to client(s) """
-        if not self.nodes.has_key(node_id):
-            raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
+        self.check_node(node_id)
         if not self.tasks.has_key(task_id):
             raise JSONRPCError(jsonrpc.INVALID_TASK_ID)
+        if not self.check_result(task_id, node_id):
+            return False
+        for done_id in self.complete_task(task_id, dict(error=error)):
+            self.announce_result(done_id)
+        return True
+
+    def node_task_results(self, node_id, results):
+        """ Saves a batch of results -- each a dict with the task_id and
+        either a result or an error -- and announces them once per client.
+        Returns the number saved.
+        """
+        self.check_node(node_id)
+        task_ids = []
+        stored = 0
+        for report in results:
+            task_id = report.get("task_id")
+            if not self.tasks.has_key(task_id):
+                logging.warning("Dropping result for unknown task %s",
+                                task_id)
+                continue
+            if not self.check_result(task_id, node_id):
+                continue
+            task_ids.extend(self.complete_task(task_id, report))
+            stored += 1
+        self.announce_results(task_ids)
+        return stored
+
+    def complete_task(self, task_id, report):
+        """ Stores a task's result, or its error if it failed, along
+        with any identical tasks that were waiting on it. Returns the
+        ids of every task completed.
+        """
         task = self.tasks[task_id]
-        task["_status"] = zerotask.FAILED
-        task["error"] = error
+        assigned = task.pop("_assigned", None)
+        if assigned is not None:
+            # assignment to result, so transfer and node queueing count
+            self.stats.observe("run_seconds", task["method"],
+                               time.time() - assigned)
+        key = task.pop("_key", None)
+        if key is not None:
+            if self.inflight.get(key) == task_id:
+                del self.inflight[key]
+            if not report.has_key("error"):
+                self.cache_store(key, report.get("result"))
+        if report.has_key("error"):
+            self.stats.incr("tasks_failed", task["method"])
+            task["_status"] = zerotask.FAILED
+            task["error"] = report["error"]
+            self.record(journal.FAILED, task_id, report["error"])
+        else:
+            self.stats.incr("tasks_finished", task["method"])
+            if task.get("_workflow") and task.has_key("_parts"):
+                # a streaming step hands its parts on as one list
+                report = dict(report, result=task.pop("_parts"))
+            task["_status"] = zerotask.FINISHED
+            task["result"] = report.get("result")
+            self.record(journal.FINISHED, task_id, report.get("result"))
+        if task.get("_workflow"):
+            # the result goes on to the steps that use it, not the client
+            completed = self.advance_workflow(task["_workflow"])
+        else:
+            self.retain_result(task_id, task)
+            completed = [task_id]
+            client = self.clients.get(task_id.split("-", 1)[0])
+            if client:
+                # the client gets client_timeout to pick the result up
+                client["activity"] = time.time()
+        for follower_id in self.followers.pop(task_id, []):
+            follower = self.tasks.get(follower_id)
+            if follower:
+                follower.pop("_follows", None)
+                completed.extend(self.complete_task(follower_id, report))
+        return completed
+
+    def announce_result(self, task_id):
+        """ Tells the owning client a result is ready. Task ids start
+        with the client id, so clients only subscribe to their own.
+        """
         announce_method = "zerotask.client.task_result_ready"
         announce_params = dict(task_id=task_id)
         pub_message = jsonrpc.request(method=announce_method,
                                       params=announce_params,
                                       id=None) # notification
-        logging.info("Publishing message %s", pub_message)
-        self.publish_socket.send_json(pub_message)
+        self.publish(task_id, pub_message)
+
+    def announce_results(self, task_ids):
+        """ Tells each owning client about all of its ready results in
+        one notification
+        """
+        by_client = collections.OrderedDict()
+        for task_id in task_ids:
+            client_id = task_id.split("-", 1)[0]
+            by_client.setdefault(client_id, []).append(task_id)
+        announce_method = "zerotask.client.task_results_ready"
+        for client_id, client_task_ids in by_client.iteritems():
+            announce_params = dict(task_ids=client_task_ids)
+            pub_message = jsonrpc.request(method=announce_method,
+                                          params=announce_params,
+                                          id=None) # notification
+            self.publish("%s-" % client_id, pub_message)
+
+    def publish(self, topic, message):
+        """ Publishes a message under a topic frame. With records
+        waiting on the journal, it waits for the group commit too, so
+        a client never hears about a result that isn't on disk.
+        """
+        if self.journal and self.journal.pending():
+            self.held_publishes.append((topic, message))
+            return
+        logging.info("Publishing message %s", message)
+        self.stats.incr("messages_published")
+        self.send(self.publish_socket, message, [str(topic)])
+
+    # Stats
+    # -----
+
+    def node_stats(self, node_id, stats):
+        """ Stores the latest stats a node reported """
+        node = self.check_node(node_id)
+        node["stats"] = stats
         return True
 
+    def stats_report(self, format="json"):
+        """ Returns the broker's stats and the latest from each node, as
+        {"broker": STATS, "nodes": {NODEID: STATS}}, or as Prometheus
+        text with format="prometheus"
+        """
+        for method in self.queues:
+            depth = len([task_id for task_id in self.queues[method]
+                         if self.tasks.has_key(task_id) and
+                         self.tasks[task_id]["_status"] == zerotask.QUEUED])
+            self.stats.gauge("queue_depth", method, depth)
+        for name, method in self.stats.gauges.keys():
+            if name == "queue_depth" and not self.queues.has_key(method):
+                self.stats.gauge("queue_depth", method, 0)
+        self.stats.gauge("tasks", value=len(self.tasks))
+        self.stats.gauge("clients", value=len(self.clients))
+        self.stats.gauge("nodes", value=len(self.nodes))
+        self.stats.gauge("result_bytes", value=self.result_bytes)
+        self.stats.gauge("cache_entries", value=len(self.cache))
+        report = dict(broker=self.stats.snapshot(),
+                      nodes=dict([(node_id, node["stats"]) for node_id, node
+                                  in self.nodes.iteritems()
+                                  if node.get("stats")]))
+        if format == "prometheus":
+            snapshots = [(dict(), report["broker"])]
+            for node_id, node_stats in sorted(report["nodes"].items()):
+                snapshots.append((dict(node=node_id), node_stats))
+            return stats.prometheus(snapshots)
+        return report
+
+    # Profiling
+    # ---------
+
+    def profile_start(self, rate=1.0, path=None):
+        """ Profiles a fraction (rate) of broker handler calls, adding
+        them up per method. With a path, the profiles are also dumped
+        there every so often.
+        """
+        profiler = self.dispatcher.profiler
+        if profiler is None:
+            profiler = self.dispatcher.profiler = SamplingProfiler()
+        profiler.rate = rate
+        profiler.path = path
+        return True
+
+    def profile_stop(self):
+        """ Stops profiling, dumping the profiles if there's a path """
+        self.dump_profiles()
+        self.dispatcher.profiler = None
+        return True
+
+    def profile_report(self, method=None, limit=20, sort="cumulative"):
+        """ Returns {method: pstats text} for the sampled calls so far """
+        if self.dispatcher.profiler is None:
+            return {}
+        return self.dispatcher.profiler.report(method, limit, sort)
+
+    def dump_profiles(self):
+        """ Writes the profiles to disk, if profiling with a path """
+        if self.dispatcher.profiler is not None:
+            self.dispatcher.profiler.dump(prefix="broker-")
+
 
 def main():
     """ Start up a simple broker. """
@@ -216,13 +1472,76 @@ def main():
                        default=5556, help="the publish socket port")
     options.add_option("-a", "--address", dest="address",
                        default="*", help="the bind address")
+    options.add_option("-c", "--codec", dest="codec",
+                       default="json", help="json|msgpack")
+    options.add_option("-j", "--journal", dest="journal",
+                       default=None, help="the task journal file")
+    options.add_option("--result-ttl", dest="result_ttl", type="float",
+                       default=None,
+                       help="seconds to keep uncollected results")
+    options.add_option("--client-timeout", dest="client_timeout",
+                       type="float", default=None,
+                       help="seconds before idle clients (with no tasks "
+                            "left to run) are dropped")
+    options.add_option("--node-timeout", dest="node_timeout",
+                       type="float", default=TIMEOUT,
+                       help="seconds before silent nodes are dropped")
+    options.add_option("--max-memory", dest="max_memory", type="int",
+                       default=None, help="bytes of results kept in memory")
+    options.add_option("--spill-path", dest="spill_path", default=None,
+                       help="directory for results spilled to disk")
+    options.add_option("--spill-size", dest="spill_size", type="int",
+                       default=None, help="spill results at least this big")
+    options.add_option("--cache-size", dest="cache_size", type="int",
+                       default=10000, help="pure task results to cache "
+                                           "(0 turns caching off)")
+    options.add_option("--cache-ttl", dest="cache_ttl", type="float",
+                       default=300, help="seconds to cache pure results")
+    options.add_option("--profile-rate", dest="profile_rate", type="float",
+                       default=None, help="fraction of calls to profile")
+    options.add_option("--profile-path", dest="profile_path", default=None,
+                       help="directory to dump profiles in")
+    options.add_option("--replicate-port", dest="replicate_port",
+                       type="int", default=None,
+                       help="publish state changes to replicas on this port")
+    options.add_option("--replica-of", dest="replica_of", default=None,
+                       help="ADDRESS:REQUEST_PORT:REPLICATE_PORT of the "
+                            "primary to replicate")
+    options.add_option("--failover-timeout", dest="failover_timeout",
+                       type="float", default=5,
+                       help="seconds of primary silence before a replica "
+                            "takes over (0 for never)")
+    options.add_option("--reject-unroutable", dest="reject_unroutable",
+                       action="store_true", default=False,
+                       help="reject tasks no connected node can run")
     options.add_option("-l", "--loglevel", dest="loglevel",
                        default="WARNING", help="INFO|WARNING|ERROR")
 
     opts, args = options.parse_args()
     logging.getLogger().setLevel(getattr(logging, opts.loglevel))
+    primary_uri = primary_replicate_uri = None
+    if opts.replica_of:
+        try:
+            address, req_port, replicate_port = opts.replica_of.rsplit(":", 2)
+        except ValueError:
+            options.error("The primary is ADDRESS:REQUEST_PORT:REPLICATE_PORT")
+        primary_uri = "tcp://%s:%s" % (address, req_port)
+        primary_replicate_uri = "tcp://%s:%s" % (address, replicate_port)
     broker = Broker(reply_port=opts.reply_port, publish_port=opts.pub_port,
-                    address=opts.address)
+                    address=opts.address, codec=opts.codec,
+                    journal=opts.journal, result_ttl=opts.result_ttl,
+                    client_timeout=opts.client_timeout,
+                    node_timeout=opts.node_timeout,
+                    max_memory=opts.max_memory, spill_path=opts.spill_path,
+                    spill_size=opts.spill_size, cache_size=opts.cache_size,
+                    cache_ttl=opts.cache_ttl,
+                    profile_rate=opts.profile_rate,
+                    profile_path=opts.profile_path,
+                    replicate_port=opts.replicate_port,
+                    primary_uri=primary_uri,
+                    primary_replicate_uri=primary_replicate_uri,
+                    failover_timeout=opts.failover_timeout,
+                    reject_unroutable=opts.reject_unroutable)
     logging.info("Starting broker request on port %d", opts.reply_port)
     logging.info("Starting broker publish on port %d", opts.pub_port)
     broker.start()
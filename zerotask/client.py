@@ -4,89 +4,779 @@ import zmq
 import logging
 import optparse
 import re
+import Queue
+import itertools
+import threading
+import zerotask
 from zerotask import jsonrpc
+from zerotask import codec
+from zerotask import frames
 from zerotask.exceptions import JSONRPCError
+from zerotask.ring import HashRing
+
+MAP_WINDOW = 100 # tasks (chunks) a map keeps in flight
+
+
+def check_response(response):
+    """ Raises the error from a JSON-RPC response, if there is one """
+    if response.has_key("error"):
+        raise JSONRPCError(response["error"]["code"],
+                           response["error"].get("message"))
+
+def ready_task_ids(message):
+    """ Returns the task ids a result notification announces (one for
+    task_result_ready, any number for task_results_ready)
+    """
+    method = message.get("method")
+    params = message.get("params") or {}
+    if method == "zerotask.client.task_result_ready":
+        return [params.get("task_id")]
+    if method == "zerotask.client.task_results_ready":
+        return params.get("task_ids", [])
+    logging.info("Method %s not important.", method)
+    return []
+
+def status_update(message):
+    """ Returns the params of a task_status notification (a running
+    task's progress or parts), or None for anything else
+    """
+    if message.get("method") == "zerotask.client.task_status":
+        return message.get("params") or {}
+    return None
+
+def shard_uris(request_uri, subscribe_uri=None):
+    """ Returns (request uris, subscribe uris) for one broker, or for a
+    list of broker shards
+    """
+    request_uris = request_uri
+    if type(request_uris) not in (list, tuple):
+        request_uris = [request_uri]
+    subscribe_uris = subscribe_uri
+    if subscribe_uris and type(subscribe_uris) not in (list, tuple):
+        subscribe_uris = [subscribe_uri]
+    if not subscribe_uris:
+        # setting sub port to 5556 by default
+        subscribe_uris = [re.sub(":\d+", ":5556", uri)
+                          for uri in request_uris]
+    if len(subscribe_uris) != len(request_uris):
+        raise ValueError("Every broker shard needs a subscribe uri")
+    return list(request_uris), list(subscribe_uris)
+
+def connect_shards(client_id, shards, request):
+    """ Registers a client with every broker shard, in order. The first
+    one picks the client id (unless there already is one), and the
+    rest are told it. request(params, shard) returns the response.
+    """
+    for shard in shards:
+        params = client_id and dict(client_id=client_id) or []
+        response = request(params, shard)
+        check_response(response)
+        if not response.get("result") or \
+                (client_id and response["result"] != client_id):
+            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
+        client_id = response["result"]
+    logging.info("New client id: %s", client_id)
+    return client_id
+
+def chain_steps(calls):
+    """ Turns a list of (method, params) calls into workflow steps that
+    run in order, each getting the result before it as its first
+    argument. Returns the steps and the name of the last one. The first
+    call's params can be anything, but the rest need a list or tuple to
+    put that argument in.
+    """
+    if not calls:
+        raise ValueError("A chain needs at least one call")
+    steps = {}
+    for index, (method, params) in enumerate(calls):
+        if index:
+            if type(params) not in (list, tuple):
+                raise ValueError("Chained calls after the first need "
+                                 "positional (list) params")
+            params = [{"$result": str(index - 1)}] + list(params)
+        steps[str(index)] = dict(method=method, params=params)
+    return steps, str(len(calls) - 1)
 
 class Client(object):
-    """ A ZeroTask client instance """
+    """ A ZeroTask client instance. Hand it lists of request and
+    subscribe uris to spread tasks over sharded brokers.
+    """
 
-    def __init__(self, request_uri, subscribe_uri=None):
-        self._request_uri = request_uri
+    def __init__(self, request_uri, subscribe_uri=None, **kwargs):
+        self._request_uris, self._subscribe_uris = shard_uris(request_uri,
+                                                              subscribe_uri)
+        self._request_uri = self._request_uris[0]
+        self._subscribe_uri = self._subscribe_uris[0]
+        # tasks go to the shard that owns their id
+        self.ring = HashRing(self._request_uris)
         self._client_id = None
-        if not subscribe_uri:
-            # setting sub port to 5556 by default
-            subscribe_uri = re.sub(":\d+", ":5556", request_uri)
-        self._subscribe_uri = subscribe_uri
-        self.context = zmq.Context()
-        self._req_socket = self.context.socket(zmq.REQ)
-        self._req_socket.connect(self._request_uri)
+        self.codec = codec.get_codec(kwargs.get("codec", "json"))
+        # share a context to reach an embedded broker over inproc://
+        self.own_context = not kwargs.get("context")
+        self.context = kwargs.get("context") or zmq.Context()
+        self._req_sockets = {} # shard (request uri) -> REQ socket
+        for uri in self._request_uris:
+            self._req_sockets[uri] = self.context.socket(zmq.REQ)
+            self._req_sockets[uri].connect(uri)
+        self._req_socket = self._req_sockets[self._request_uri]
+        # one SUB socket hears every shard
         self._sub_socket = self.context.socket(zmq.SUB)
-        self._sub_socket.connect(self._subscribe_uri)
-        self._sub_socket.setsockopt(zmq.SUBSCRIBE, "")
+        for uri in self._subscribe_uris:
+            self._sub_socket.connect(uri)
         self._client_id = self._get_client_id()
+        # only our own notifications -- filtered by zmq, not by us
+        topic = str("%s-" % self._client_id)
+        self._sub_socket.setsockopt(zmq.SUBSCRIBE, topic)
 
     def _get_client_id(self):
-        """ Tries to connect to broker and get client id """
-        method = "zerotask.broker.client_connect"
-        params = []
-        request = jsonrpc.request(method, params)
-        self._req_socket.send_json(request)
-        response = self._req_socket.recv_json()
-        if response.has_key("error"):
-            raise JSONRPCError(response["error"]["code"],
-                               response["error"].get("message"))
-        client_id = response.get("result")
-        if not client_id:
-            raise JSONRPCError(jsonrpc.INVALID_CLIENT_ID)
-        logging.info("New client id: %s", client_id)
-        return client_id
+        """ Tries to connect to every broker shard and get client id """
+        def request(params, shard):
+            """ Sends one client_connect """
+            method = "zerotask.broker.client_connect"
+            return self._request(jsonrpc.request(method, params), shard)
+        return connect_shards(self._client_id, self._request_uris, request)
+
+    def _request(self, request, shard=None):
+        """ Sends a request (or batch) to a broker shard (the first by
+        default), returns the response
+        """
+        socket = self._req_sockets[shard or self._request_uri]
+        frames.send(socket, request, self.codec)
+        return frames.recv(socket)[1]
+
+    def _request_shards(self, requests):
+        """ Sends {shard: request} to all the shards at once, and
+        returns {shard: response}
+        """
+        for shard, request in requests.items():
+            frames.send(self._req_sockets[shard], request, self.codec)
+        return dict([(shard, frames.recv(self._req_sockets[shard])[1])
+                     for shard in requests])
+
+    def _new_task_id(self):
+        """ Returns (task id, full task id, owning shard) for a new task """
+        task_id = jsonrpc.get_random_id()
+        full_id = "%s-%s" % (self._client_id, task_id)
+        return task_id, full_id, self.ring.get(full_id)
+
+    def _notification(self):
+        """ Waits for the next published notification """
+        return frames.recv(self._sub_socket)[1]
 
     def _dispatch(self, method, *args, **kwargs):
         """ Turns a request into a JSON-RPC call and calls it """
+        task_id, shard = self._new_task(method, args or kwargs)
+        return self._wait_result(task_id, shard)
+
+    def _new_task(self, method, params):
+        """ Submits a task, and returns its full id and shard """
+        task_id, full_id, shard = self._new_task_id()
         req_method = "zerotask.broker.client_new_task"
-        req_params = dict(client_id=self._client_id, method=method)
-        if args:
-            req_params["params"] = args
-        else:
-            req_params["params"] = kwargs
+        req_params = dict(client_id=self._client_id, method=method,
+                          task_id=task_id, params=params)
         req_obj = jsonrpc.request(req_method, req_params)
         logging.info("Sending message %s", req_obj)
-        self._req_socket.send_json(req_obj)
-        result = self._req_socket.recv_json()
+        result = self._request(req_obj, shard)
         logging.info("Recieved response %s", result)
         if result.get("error"):
             raise JSONRPCError(result["error"]["code"],
                                result["error"].get("message"))
         task_id = result["result"]
         logging.info("New task id: %s", task_id)
+        return task_id, shard
+
+    def stream(self, method, *args, **kwargs):
+        """ Runs a generator task, and yields its parts as they come in.
+        The task only gets a few parts ahead of what's been taken from
+        here. Raises the task error if it fails.
+        """
+        task_id, shard = self._new_task(method, args or kwargs)
+        parts_params = dict(client_id=self._client_id, task_id=task_id)
+        while True:
+            parts_req = jsonrpc.request("zerotask.broker.client_task_parts",
+                                        parts_params)
+            response = self._request(parts_req, shard)
+            check_response(response)
+            for part in response["result"]["parts"]:
+                yield part
+            if response["result"]["parts"]:
+                continue
+            if response["result"]["status"] in (zerotask.FINISHED,
+                                                zerotask.FAILED):
+                break
+            # wait for news of the task -- more parts, or the result
+            while True:
+                message = self._notification()
+                update = status_update(message)
+                if task_id in ready_task_ids(message) or \
+                        (update and update.get("task_id") == task_id):
+                    break
+        result_req = jsonrpc.request("zerotask.broker.client_task_result",
+                                     parts_params)
+        check_response(self._request(result_req, shard))
+
+    def _wait_result(self, task_id, shard):
+        """ Waits for a task's notification, then fetches its result """
         result_response = None
         while True:
-            sub_result = self._sub_socket.recv_json()
+            sub_result = self._notification()
             logging.info("Recieved response %s", sub_result)
-            sub_method = sub_result.get("method")
-            sub_params = sub_result.get("params")
-            if sub_method != "zerotask.client.task_result_ready":
-                logging.info("Method %s not important.", sub_method)
-                continue
-            if sub_params.get("task_id") != task_id:
-                logging.info("%s != %s" % (sub_params.get("task_id"), task_id))
+            if task_id not in ready_task_ids(sub_result):
                 continue
             result_method = "zerotask.broker.client_task_result"
             result_params = dict(client_id=self._client_id,
                                  task_id=task_id)
             result_req = jsonrpc.request(result_method, result_params)
-            self._req_socket.send_json(result_req)
-            result_response = self._req_socket.recv_json()
+            result_response = self._request(result_req, shard)
             break
         if result_response.has_key("error"):
             raise JSONRPCError(result_response["error"]["code"],
                                result_response["error"].get("message"))
         return result_response.get("result")
 
+    def batch(self, calls):
+        """ Submits a list of (method, params) calls in one request
+        and returns their results in order. Raises the first task error.
+        """
+        if not calls:
+            return []
+        req_method = "zerotask.broker.client_new_tasks"
+        task_ids = []
+        shard_tasks = {} # shard -> tasks it owns
+        for method, params in calls:
+            task_id, full_id, shard = self._new_task_id()
+            task_ids.append((full_id, shard))
+            shard_tasks.setdefault(shard, []).append(
+                dict(method=method, params=params, task_id=task_id))
+        requests = {}
+        for shard, tasks in shard_tasks.items():
+            requests[shard] = jsonrpc.request(req_method,
+                                              dict(client_id=self._client_id,
+                                                   tasks=tasks))
+        for response in self._request_shards(requests).values():
+            check_response(response)
+        waiting = set([task_id for task_id, shard in task_ids])
+        while waiting:
+            sub_result = self._notification()
+            waiting.difference_update(ready_task_ids(sub_result))
+        # fetching all the results is a single JSON-RPC batch per shard
+        result_method = "zerotask.broker.client_task_result"
+        result_reqs = []
+        requests = {}
+        for task_id, shard in task_ids:
+            result_req = jsonrpc.request(result_method,
+                                         dict(client_id=self._client_id,
+                                              task_id=task_id))
+            result_reqs.append(result_req)
+            requests.setdefault(shard, []).append(result_req)
+        responses = {}
+        for shard_responses in self._request_shards(requests).values():
+            responses.update([(r.get("id"), r) for r in shard_responses])
+        results = []
+        for result_req in result_reqs:
+            result_response = responses[result_req["id"]]
+            check_response(result_response)
+            results.append(result_response.get("result"))
+        return results
+
+    def workflow(self, steps, outputs=None):
+        """ Runs a workflow of steps on the broker (see
+        Broker.client_new_workflow) and returns its result
+        """
+        task_id, full_id, shard = self._new_task_id()
+        req_params = dict(client_id=self._client_id, steps=steps,
+                          task_id=task_id)
+        if outputs is not None:
+            req_params["outputs"] = outputs
+        req_obj = jsonrpc.request("zerotask.broker.client_new_workflow",
+                                  req_params)
+        response = self._request(req_obj, shard)
+        check_response(response)
+        return self._wait_result(response["result"], shard)
+
+    def chain(self, calls):
+        """ Runs a list of (method, params) calls in order on the broker,
+        each getting the result before it as its first argument, and
+        returns the last result
+        """
+        steps, last = chain_steps(calls)
+        return self.workflow(steps, last)
+
+    def close(self):
+        """ Closes the sockets """
+        if self.own_context:
+            self.context.destroy(linger=0)
+            return
+        for socket in self._req_sockets.values():
+            socket.close(linger=0)
+        self._sub_socket.close(linger=0)
+
     def __getattr__(self, attr):
         """ Returns an attribute tree """
         return AttribTree(self, attr)
 
+class AsyncClient(object):
+    """ A ZeroTask client that doesn't block on results. Calls return
+    TaskWaiter objects right away, and a single I/O thread routes broker
+    replies and result notifications to the matching waiters, so many
+    tasks can be in flight over one connection.
+    """
+
+    def __init__(self, request_uri, subscribe_uri=None, **kwargs):
+        self._request_uris, self._subscribe_uris = shard_uris(request_uri,
+                                                              subscribe_uri)
+        self._request_uri = self._request_uris[0]
+        self._subscribe_uri = self._subscribe_uris[0]
+        # tasks go to the shard that owns their id
+        self.ring = HashRing(self._request_uris)
+        self._client_id = None
+        self.codec = codec.get_codec(kwargs.get("codec", "json"))
+        self._waiters = {} # task id -> waiter
+        self._pending = {} # request id -> response callback
+        self._send_lock = threading.Lock()
+        # share a context to reach an embedded broker over inproc://
+        self.own_context = not kwargs.get("context")
+        self.context = kwargs.get("context") or zmq.Context()
+        # DEALER instead of REQ, so requests don't wait on each other
+        self._req_sockets = {} # shard (request uri) -> DEALER socket
+        for uri in self._request_uris:
+            self._req_sockets[uri] = self.context.socket(zmq.DEALER)
+            self._req_sockets[uri].connect(uri)
+        # status checks go to read replicas, if there are any (one per
+        # shard, in the same order)
+        self._replicas = {} # shard -> replica uri
+        replica_uris = kwargs.get("replica_uri") or []
+        if type(replica_uris) not in (list, tuple):
+            replica_uris = [replica_uris]
+        for shard, uri in zip(self._request_uris, replica_uris):
+            self._replicas[shard] = uri
+            self._req_sockets[uri] = self.context.socket(zmq.DEALER)
+            self._req_sockets[uri].connect(uri)
+        self._sub_socket = self.context.socket(zmq.SUB)
+        self._sub_socket.setsockopt(zmq.RCVHWM, 0)
+        for uri in self._subscribe_uris:
+            self._sub_socket.connect(uri)
+        # requests from user threads are handed to the I/O thread
+        command_uri = "inproc://zerotask-client-%d" % id(self)
+        self._command_socket = self.context.socket(zmq.PULL)
+        self._command_socket.bind(command_uri)
+        self._queue_socket = self.context.socket(zmq.PUSH)
+        self._queue_socket.connect(command_uri)
+        self._client_id = self._get_client_id()
+        topic = str("%s-" % self._client_id)
+        self._sub_socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self._thread = threading.Thread(target=self._loop,
+                                        name="zerotask-client")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_client_id(self):
+        """ Connects to every broker shard (before the I/O thread starts) """
+        def request(params, shard):
+            """ Sends one client_connect """
+            socket = self._req_sockets[shard]
+            request = jsonrpc.request("zerotask.broker.client_connect",
+                                      params)
+            frames.send(socket, request, self.codec, [""])
+            return frames.recv(socket)[1]
+        return connect_shards(self._client_id, self._request_uris, request)
+
+    def _loop(self):
+        """ The I/O thread -- the only user of the broker sockets """
+        poller = zmq.Poller()
+        poller.register(self._command_socket, zmq.POLLIN)
+        for socket in self._req_sockets.values():
+            poller.register(socket, zmq.POLLIN)
+        poller.register(self._sub_socket, zmq.POLLIN)
+        while True:
+            socks = dict(poller.poll())
+            if socks.get(self._command_socket) == zmq.POLLIN:
+                parts = self._command_socket.recv_multipart(copy=False)
+                if not len(parts[0]):
+                    break # closing
+                # the shard, then the already encoded body plus any
+                # attachment frames
+                socket = self._req_sockets[parts[0].bytes]
+                socket.send_multipart([""] + parts[1:], copy=False)
+            for socket in self._req_sockets.values():
+                if socks.get(socket) != zmq.POLLIN:
+                    continue
+                responses = frames.recv(socket)[1]
+                if type(responses) is not list:
+                    responses = [responses]
+                for response in responses:
+                    callback = self._pending.pop(response.get("id"), None)
+                    if callback:
+                        callback(response)
+            if socks.get(self._sub_socket) == zmq.POLLIN:
+                message = frames.recv(self._sub_socket)[1]
+                self._notify(message)
+        logging.info("Client I/O thread stopped.")
+
+    def _notify(self, message):
+        """ Fetches the results for waiters whose tasks are done -- in
+        one JSON-RPC batch if several were announced together
+        """
+        update = status_update(message)
+        if update is not None:
+            waiter = self._waiters.get(update.get("task_id"))
+            if waiter:
+                waiter._set_status(update)
+            return
+        shard_requests = {} # shard -> requests
+        for task_id in ready_task_ids(message):
+            waiter = self._waiters.get(task_id)
+            if waiter and waiter.streaming:
+                # parts() takes the rest of the parts, then the result
+                waiter._more.set()
+                continue
+            waiter = self._waiters.pop(task_id, None)
+            if not waiter:
+                continue # someone else's task
+            result_method = "zerotask.broker.client_task_result"
+            result_params = dict(client_id=self._client_id, task_id=task_id)
+            request = jsonrpc.request(result_method, result_params)
+            self._pending[request["id"]] = waiter._set_response
+            shard_requests.setdefault(self.ring.get(task_id),
+                                      []).append(request)
+        for shard, requests in shard_requests.items():
+            if len(requests) == 1:
+                requests = requests[0]
+            frames.send(self._req_sockets[shard], requests, self.codec, [""])
+
+    def _send(self, request, callback=None, shard=None):
+        """ Queues a request for the I/O thread to send to a broker
+        shard (the first by default). The callback gets the response,
+        and runs in the I/O thread.
+        """
+        if callback:
+            self._pending[request["id"]] = callback
+        with self._send_lock:
+            frames.send(self._queue_socket, request, self.codec,
+                        [str(shard or self._request_uri)])
+
+    def _call(self, method, params, shard=None):
+        """ Sends a request and blocks until the response comes back.
+        Don't call this from a waiter callback.
+        """
+        responses = []
+        done = threading.Event()
+        def callback(response):
+            """ Hands the response back to the calling thread """
+            responses.append(response)
+            done.set()
+        self._send(jsonrpc.request(method, params), callback, shard)
+        done.wait()
+        check_response(responses[0])
+        return responses[0].get("result")
+
+    def _dispatch(self, method, *args, **kwargs):
+        """ Submits a task and returns its waiter """
+        req_params = dict(method=method)
+        if args:
+            req_params["params"] = args
+        else:
+            req_params["params"] = kwargs
+        return self._submit("zerotask.broker.client_new_task", req_params)
+
+    def _submit(self, req_method, req_params, streaming=False):
+        """ Sends a new task (or workflow) request under a fresh task
+        id, and returns its waiter
+        """
+        task_id = jsonrpc.get_random_id()
+        full_id = "%s-%s" % (self._client_id, task_id)
+        shard = self.ring.get(full_id)
+        waiter = TaskWaiter(self, full_id, streaming)
+        # registered before submitting, so the notification can't beat it
+        self._waiters[full_id] = waiter
+        req_params.update(client_id=self._client_id, task_id=task_id)
+        req_obj = jsonrpc.request(req_method, req_params)
+        logging.info("Sending message %s", req_obj)
+        self._send(req_obj, waiter._submitted, shard)
+        return waiter
+
+    def batch(self, calls, chunk=False):
+        """ Submits a list of (method, params) calls in one request
+        and returns their waiters in order. With chunk, each call's params
+        are a list of params, and it runs the method once per entry.
+        """
+        waiters = []
+        shard_tasks = {} # shard -> (waiters, tasks)
+        for method, params in calls:
+            task_id = jsonrpc.get_random_id()
+            full_id = "%s-%s" % (self._client_id, task_id)
+            waiter = TaskWaiter(self, full_id)
+            self._waiters[full_id] = waiter
+            waiters.append(waiter)
+            shard_waiters, tasks = shard_tasks.setdefault(
+                self.ring.get(full_id), ([], []))
+            shard_waiters.append(waiter)
+            task = dict(method=method, params=params, task_id=task_id)
+            if chunk:
+                task["chunk"] = True
+            tasks.append(task)
+        def submitted(shard_waiters):
+            """ Returns a callback that fails the shard's waiters if its
+            part of the batch was rejected
+            """
+            def callback(response):
+                """ Passes the response on to each waiter """
+                for waiter in shard_waiters:
+                    waiter._submitted(response)
+            return callback
+        req_method = "zerotask.broker.client_new_tasks"
+        for shard, (shard_waiters, tasks) in shard_tasks.items():
+            req_obj = jsonrpc.request(req_method,
+                                      dict(client_id=self._client_id,
+                                           tasks=tasks))
+            self._send(req_obj, submitted(shard_waiters), shard)
+        return waiters
+
+    def stream(self, method, *args, **kwargs):
+        """ Submits a generator task and returns its waiter. Iterate over
+        waiter.parts() to take its parts as they come in -- the task only
+        gets a few parts ahead of that. The waiter's result is the
+        number of parts.
+        """
+        req_params = dict(method=method, params=args or kwargs)
+        return self._submit("zerotask.broker.client_new_task", req_params,
+                            streaming=True)
+
+    def workflow(self, steps, outputs=None):
+        """ Submits a workflow of steps to the broker (see
+        Broker.client_new_workflow) and returns its waiter
+        """
+        req_params = dict(steps=steps)
+        if outputs is not None:
+            req_params["outputs"] = outputs
+        return self._submit("zerotask.broker.client_new_workflow",
+                            req_params)
+
+    def chain(self, calls):
+        """ Submits a list of (method, params) calls to run in order on
+        the broker, each getting the result before it as its first
+        argument. The waiter gets the last result.
+        """
+        steps, last = chain_steps(calls)
+        return self.workflow(steps, last)
+
+    def imap_unordered(self, method, iterable, chunksize=1,
+                       window=MAP_WINDOW):
+        """ Calls a method with each item as its argument, and yields the
+        results as they finish (in any order). Items are sent chunksize
+        calls to a task, with at most window tasks in flight, so the
+        iterable can be long (or endless). A failed call raises its error.
+        """
+        for index, result in self._map(method, iterable, chunksize, window):
+            yield result
+
+    def map(self, method, iterable, chunksize=1, window=MAP_WINDOW,
+            reduce=None, initial=None):
+        """ Like imap_unordered, but returns the list of results in item
+        order. With a reduce function, the results are folded into one
+        value as they arrive instead (so in no particular order), starting
+        from initial, and that value is returned.
+        """
+        results = self._map(method, iterable, chunksize, window)
+        if reduce is not None:
+            value = initial
+            for index, result in results:
+                value = reduce(value, result)
+            return value
+        ordered = {}
+        for index, result in results:
+            ordered[index] = result
+        return [ordered[index] for index in range(len(ordered))]
+
+    def _map(self, method, iterable, chunksize, window):
+        """ Yields (item index, result) as the calls finish """
+        items = iter(iterable)
+        window = max(1, window)
+        chunked = chunksize > 1
+        finished = Queue.Queue() # (first item index, waiter)
+        def track(start, waiter):
+            """ Queues the waiter once it's done, either way """
+            def done(value):
+                """ Hands the waiter to the map thread """
+                finished.put((start, waiter))
+            waiter.callback(done, done)
+        in_flight = 0
+        next_index = 0
+        while True:
+            # top up the window, in one request per shard
+            calls = []
+            starts = []
+            while in_flight + len(calls) < window:
+                chunk = list(itertools.islice(items, chunksize))
+                if not chunk:
+                    break
+                if chunked:
+                    calls.append((method, [[item] for item in chunk]))
+                else:
+                    calls.append((method, chunk))
+                starts.append(next_index)
+                next_index += len(chunk)
+            if calls:
+                for start, waiter in zip(starts, self.batch(calls, chunked)):
+                    track(start, waiter)
+                in_flight += len(calls)
+            if not in_flight:
+                return
+            start, waiter = finished.get()
+            in_flight -= 1
+            if waiter.error:
+                raise waiter.error
+            if not chunked:
+                yield start, waiter.result
+                continue
+            for offset, response in enumerate(waiter.result):
+                check_response(response)
+                yield start + offset, response.get("result")
+
+    def close(self):
+        """ Stops the I/O thread and closes the sockets """
+        with self._send_lock:
+            self._queue_socket.send("")
+        self._thread.join()
+        if self.own_context:
+            self.context.destroy(linger=0)
+            return
+        for socket in self._req_sockets.values() + [
+                self._sub_socket, self._command_socket, self._queue_socket]:
+            socket.close(linger=0)
+
+    def __getattr__(self, attr):
+        """ Returns an attribute tree """
+        return AttribTree(self, attr)
+
+
+class TaskWaiter(object):
+    """ A handle on a task submitted with an AsyncClient """
+
+    def __init__(self, client, task_id, streaming=False):
+        self.client = client
+        self.task_id = task_id
+        self.result = None
+        self.error = None
+        self.progress = None # the latest the task reported, if any
+        self.streaming = streaming
+        self._more = threading.Event() # news of the task came in
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def _submitted(self, response):
+        """ Fails the waiter if the broker didn't accept the task """
+        if response.has_key("error"):
+            self.client._waiters.pop(self.task_id, None)
+            self._set_response(response)
+
+    def _set_response(self, response):
+        """ Stores the result (or error) and fires callbacks """
+        if response.has_key("error"):
+            self.error = JSONRPCError(response["error"]["code"],
+                                      response["error"].get("message"))
+        else:
+            self.result = response.get("result")
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, errback in callbacks:
+            self._fire(callback, errback)
+
+    def _set_status(self, update):
+        """ Takes a running task's progress, and wakes up parts() """
+        if update.has_key("progress"):
+            self.progress = update["progress"]
+        self._more.set()
+
+    def _fire(self, callback, errback):
+        """ Calls the right callback for the outcome """
+        if self.error:
+            if errback:
+                errback(self.error)
+        else:
+            callback(self.result)
+
+    def done(self):
+        """ Returns True once the result (or error) is in """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the task is done and returns the result.
+        Raises the task error if it failed, or TASK_NOT_COMPLETE
+        if the timeout runs out first.
+        """
+        if not self._done.wait(timeout):
+            raise JSONRPCError(jsonrpc.TASK_NOT_COMPLETE)
+        if self.error:
+            raise self.error
+        return self.result
+
+    def status(self):
+        """ Returns the task status code (zerotask.QUEUED, etc.) """
+        if self.done():
+            return self.error and zerotask.FAILED or zerotask.FINISHED
+        params = dict(client_id=self.client._client_id,
+                      task_id=self.task_id)
+        shard = self.client.ring.get(self.task_id)
+        replica = self.client._replicas.get(shard)
+        try:
+            return self.client._call("zerotask.broker.client_task_status",
+                                     params, replica or shard)
+        except JSONRPCError:
+            if self.done():
+                # the result was collected while we were asking
+                return self.status()
+            if replica:
+                # the replica may just not have caught up yet
+                return self.client._call(
+                    "zerotask.broker.client_task_status", params, shard)
+            raise
+
+    def parts(self, timeout=None):
+        """ Yields a streaming task's parts as they come in, then sets
+        the result. Raises the task error if it failed, or
+        TASK_NOT_COMPLETE if no news comes for timeout seconds.
+        """
+        params = dict(client_id=self.client._client_id,
+                      task_id=self.task_id)
+        shard = self.client.ring.get(self.task_id)
+        while not self.done():
+            self._more.clear()
+            response = self.client._call("zerotask.broker.client_task_parts",
+                                         params, shard)
+            if response.has_key("progress"):
+                self.progress = response["progress"]
+            for part in response["parts"]:
+                yield part
+            if response["parts"]:
+                continue
+            if response["status"] in (zerotask.FINISHED, zerotask.FAILED):
+                self.client._waiters.pop(self.task_id, None)
+                try:
+                    result = self.client._call(
+                        "zerotask.broker.client_task_result", params, shard)
+                    self._set_response(jsonrpc.result(result, None))
+                except JSONRPCError, error:
+                    self._set_response(error.error_response(None))
+                break
+            if not self._more.wait(timeout):
+                raise JSONRPCError(jsonrpc.TASK_NOT_COMPLETE)
+        if self.error:
+            raise self.error
+
+    def callback(self, callback, errback=None):
+        """ Calls callback(result) when the task finishes, or
+        errback(error) if it fails. Fires right away if it's already done.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, errback))
+                return
+        self._fire(callback, errback)
+
+
 class AttribTree(object):
     """ Just a holder for the namespace of a method """
 
@@ -113,6 +803,8 @@ def main():
                        default=5556, help="the broker's subscribe port")
     options.add_option("-a", "--address", dest="address",
                        default="*", help="the broker's address")
+    options.add_option("-c", "--codec", dest="codec",
+                       default="json", help="json|msgpack")
     options.add_option("-l", "--loglevel", dest="loglevel",
                        default="WARNING", help="INFO|WARNING|ERROR")
 
@@ -121,7 +813,8 @@ def main():
     logging.info("Starting client for request port %d", opts.req_port)
     logging.info("Starting client for subscribe port %d", opts.sub_port)
     client = Client(request_uri="tcp://%s:%s" % (opts.address, opts.req_port),
-                    subscribe_uri="tcp://%s:%s" % (opts.address, opts.sub_port))
+                    subscribe_uri="tcp://%s:%s" % (opts.address, opts.sub_port),
+                    codec=opts.codec)
     print "Result for 5+6:", client.add(5, 6)
     print "Result for 5-6:", client.subtract(5, 6)
 
@@ -0,0 +1,72 @@
+""" Wire codecs for message bodies.
+
+Every encoded body starts with its codec's marker byte (except JSON, which
+has no marker so older peers still understand it), and decode() picks the
+codec from that byte. A fleet can therefore run mixed codecs: upgrade every
+peer first, then switch the encoders one by one.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec(object):
+    """ Plain JSON bodies -- the default """
+
+    name = "json"
+    marker = ""
+
+    def encode(self, data):
+        """ Returns the encoded body """
+        return json.dumps(data)
+
+    def decode(self, body):
+        """ Returns the decoded body """
+        return json.loads(body)
+
+
+class MsgpackCodec(object):
+    """ msgpack bodies, which are smaller, faster, and can carry binary
+    strings. Needs the msgpack package.
+    """
+
+    name = "msgpack"
+    marker = "\x01" # version 1 -- never the first byte of a JSON body
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires msgpack.")
+
+    def encode(self, data):
+        """ Returns the marked, encoded body """
+        return self.marker + msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, body):
+        """ Returns the decoded body (without the marker) """
+        return msgpack.unpackb(buffer(body, 1), raw=False)
+
+
+CODECS = { JSONCodec.name: JSONCodec,
+           MsgpackCodec.name: MsgpackCodec }
+
+_instances = {}
+
+def get_codec(name="json"):
+    """ Returns the codec for a name (or the codec itself, if passed one) """
+    if not isinstance(name, basestring):
+        return name
+    if not _instances.has_key(name):
+        if not CODECS.has_key(name):
+            raise ValueError("Unknown codec '%s'" % name)
+        _instances[name] = CODECS[name]()
+    return _instances[name]
+
+def decode(body):
+    """ Decodes a body with whichever codec its marker byte names """
+    if body[:1] == MsgpackCodec.marker:
+        return get_codec(MsgpackCodec.name).decode(body)
+    return get_codec(JSONCodec.name).decode(body)
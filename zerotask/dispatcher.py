@@ -3,6 +3,7 @@
 from zerotask.exceptions import JSONRPCError
 from zerotask import jsonrpc
 import logging
+import time
 
 class Dispatcher(object):
     """ The dispatch service for JSON-RPC calls """
@@ -11,6 +12,10 @@ class Dispatcher(object):
 
     def __init__(self):
         self.handlers = {}
+        self.pure = set() # methods whose results only depend on params
+        self.pre_hooks = [] # hook(method, params, request_id)
+        self.post_hooks = [] # hook(method, params, response, seconds)
+        self.profiler = None # a SamplingProfiler, when profiling
         self.context = None
         self.socket = None
 
@@ -22,7 +27,12 @@ class Dispatcher(object):
         return cls._instance
 
     def dispatch(self, data):
-        """ Dispatches a JSON-RPC call """
+        """ Dispatches a JSON-RPC call (or a batch of them) """
+        if type(data) in (tuple, list):
+            return self.dispatch_batch(data)
+        if type(data) is not dict:
+            logging.warning("Invalid request")
+            return jsonrpc.error(jsonrpc.INVALID_REQUEST, None)
         method = data.get('method')
         params = data.get("params", [])
         request_id = data.get("id")
@@ -37,18 +47,18 @@ class Dispatcher(object):
                 return None
             return jsonrpc.error(jsonrpc.METHOD_NOT_FOUND, request_id)
         func = self.handlers.get(method)
+        for hook in self.pre_hooks:
+            self.run_hook(hook, method, params, request_id)
+        start = time.time()
         try:
-            if type(params) in (tuple, list):
-                result = func(*params)
-            else:
-                result = func(**params)
-            result_obj = jsonrpc.result(result, request_id)
-        except JSONRPCError, jerr:
-            result_obj = jerr.error_response(request_id)
+            result_obj = jsonrpc.result(self.call(method, func, params),
+                                        request_id)
         except Exception, exc:
-            error_message = str(exc)
-            error_code = jsonrpc.INTERNAL_ERROR
-            result_obj = jsonrpc.error(error_code, request_id, error_message)
+            result_obj = self.exception_response(exc, request_id)
+        if self.post_hooks:
+            elapsed = time.time() - start
+            for hook in self.post_hooks:
+                self.run_hook(hook, method, params, result_obj, elapsed)
         if not request_id:
             # Notification
             if result_obj.has_key("error"):
@@ -56,12 +66,71 @@ class Dispatcher(object):
             return None
         return result_obj
 
-    def add_handler(self, method, name=None):
-        """ Adds a handler for dispatching """
+    def call(self, method, func, params):
+        """ Calls a handler -- under the profiler, if this call is sampled """
+        args, kwargs = (), {}
+        if type(params) in (tuple, list):
+            args = params
+        else:
+            kwargs = params
+        if self.profiler is not None and self.profiler.sample():
+            return self.profiler.runcall(method, func, args, kwargs)
+        return func(*args, **kwargs)
+
+    def add_hook(self, pre=None, post=None):
+        """ Adds hooks that run around every handler call. pre gets
+        (method, params, request_id) before the call, and post gets
+        (method, params, response, seconds) after it.
+        """
+        if pre:
+            self.pre_hooks.append(pre)
+        if post:
+            self.post_hooks.append(post)
+
+    def remove_hook(self, pre=None, post=None):
+        """ Removes hooks added with add_hook """
+        if pre in self.pre_hooks:
+            self.pre_hooks.remove(pre)
+        if post in self.post_hooks:
+            self.post_hooks.remove(post)
+
+    def run_hook(self, hook, *args):
+        """ Runs a hook -- a broken hook is logged, not raised """
+        try:
+            hook(*args)
+        except Exception:
+            logging.exception("Dispatch hook %s failed", hook)
+
+    def exception_response(self, exc, request_id):
+        """ Turns an exception raised by a handler into an error response """
+        if isinstance(exc, JSONRPCError):
+            return exc.error_response(request_id)
+        return jsonrpc.error(jsonrpc.INTERNAL_ERROR, request_id, str(exc))
+
+    def dispatch_batch(self, data):
+        """ Dispatches a JSON-RPC 2.0 batch, returning the list of
+        responses (or None if they were all notifications)
+        """
+        if not data:
+            logging.warning("Empty batch")
+            return jsonrpc.error(jsonrpc.INVALID_REQUEST, None)
+        responses = []
+        for request in data:
+            response = self.dispatch(request)
+            if response is not None:
+                responses.append(response)
+        return responses or None
+
+    def add_handler(self, method, name=None, pure=False):
+        """ Adds a handler for dispatching. Pure handlers may have their
+        results cached and shared between identical calls.
+        """
         if not name:
             name = method.__name__
         logging.info("Adding method '%s'", name)
         self.handlers[name] = method
+        if pure:
+            self.pure.add(name)
 
     def has_handler(self, name):
         """ Checks if the handler is available """
@@ -0,0 +1,106 @@
+""" A Broker, a Node and its workers, all in this process.
+
+Everything shares one zmq.Context and talks over inproc:// sockets, so
+no task goes through the kernel. The Broker and Node loops (and each
+worker) get a thread, and clients connect with the same Client and
+AsyncClient API as ever -- they just share the context too.
+"""
+
+import zmq
+import logging
+import optparse
+import threading
+from zerotask.broker import Broker
+from zerotask.node import Node
+from zerotask.client import Client, AsyncClient
+from zerotask.task import task
+from zerotask import worker
+
+JOIN_TIMEOUT = 10 # seconds to wait for the broker and node to stop
+
+
+class Embedded(object):
+    """ Runs a broker and a node in background threads. Any other
+    keyword arguments go to both the Broker and the Node.
+    """
+
+    def __init__(self, name="zerotask", **kwargs):
+        self.own_context = not kwargs.get("context")
+        self.context = kwargs.pop("context", None) or zmq.Context()
+        self.options = kwargs
+        self.options.update(context=self.context, protocol="inproc",
+                            address=name, embedded=True)
+        reply_port = kwargs.get("reply_port", 5555)
+        publish_port = kwargs.get("publish_port", 5556)
+        self.request_uri = "inproc://%s:%s" % (name, reply_port)
+        self.subscribe_uri = "inproc://%s:%s" % (name, publish_port)
+        self.broker = None
+        self.node = None
+        self.threads = []
+
+    def start(self):
+        """ Starts the broker, then the node (which connects to it) """
+        self.broker = Broker(**self.options)
+        self.run(self.broker, "zerotask-broker")
+        self.node = Node(**self.options)
+        self.node.add_broker(self.request_uri, self.subscribe_uri)
+        self.run(self.node, "zerotask-node")
+        return self
+
+    def run(self, server, name):
+        """ Runs a server loop in its own thread """
+        thread = threading.Thread(target=server.start, name=name)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def client(self, **kwargs):
+        """ Returns a (blocking) Client for this broker """
+        return Client(self.request_uri, self.subscribe_uri,
+                      context=self.context, **kwargs)
+
+    def async_client(self, **kwargs):
+        """ Returns an AsyncClient for this broker """
+        return AsyncClient(self.request_uri, self.subscribe_uri,
+                           context=self.context, **kwargs)
+
+    def stop(self):
+        """ Stops the node (and its workers), then the broker. Close
+        any clients first.
+        """
+        for server in (self.node, self.broker):
+            if server:
+                server.stop()
+        for thread in self.threads:
+            thread.join(JOIN_TIMEOUT)
+        self.threads = []
+        if self.own_context:
+            self.context.destroy(linger=0)
+
+
+def main():
+    """ Runs an embedded broker and node, and calls "add" on them """
+    options = optparse.OptionParser()
+    options.add_option("-w", "--workers", dest="workers", type="int",
+                       default=1, help="the number of worker threads")
+    options.add_option("-m", "--mode", dest="mode", default=worker.PROCESS,
+                       help="|".join(worker.MODES))
+    options.add_option("-l", "--loglevel", dest="loglevel",
+                       default="WARNING", help="INFO|WARNING|ERROR")
+
+    opts, args = options.parse_args()
+    logging.getLogger().setLevel(getattr(logging, opts.loglevel))
+
+    @task
+    def add(first, second):
+        """ just an addition method test """
+        return first + second
+
+    embedded = Embedded(workers=opts.workers, worker_mode=opts.mode).start()
+    client = embedded.client()
+    print "Result for 5+6:", client.add(5, 6)
+    client.close()
+    embedded.stop()
+
+if __name__ == "__main__":
+    main()
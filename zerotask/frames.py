@@ -0,0 +1,125 @@
+""" Multipart message helpers.
+
+A message is sent as [envelope..., body, attachments...]. The envelope is
+the routing identity and delimiter (ROUTER), the delimiter (DEALER), or the
+topic (PUB / SUB). Binary values (bytearray, buffer, memoryview) anywhere in
+the message are sent as separate attachment frames without copying, and the
+body refers to them as {"zerotask.frame": INDEX}. On the way in they come
+back as memoryviews over the received frames, so they can be read -- or
+passed along to the next hop -- without another copy.
+"""
+
+import zmq
+from zerotask import codec
+
+ATTACHMENT = "zerotask.frame"
+BINARY_TYPES = (bytearray, buffer, memoryview)
+CONTAINER_TYPES = (list, tuple)
+
+
+class MalformedMessage(ValueError):
+    """ Raised for received frames that aren't a message we can read """
+    pass
+
+
+def pack(message):
+    """ Pulls binary values out of a message.
+    Returns (message, attachments). Only the containers that held binary
+    values are copied, so plain messages come back as is.
+    """
+    attachments = []
+    return _pack(message, attachments), attachments
+
+def _pack(value, attachments):
+    """ Replaces binary values with attachment references """
+    if isinstance(value, BINARY_TYPES):
+        attachments.append(value)
+        return {ATTACHMENT: len(attachments) - 1}
+    value_type = type(value)
+    if value_type is dict:
+        packed = None
+        for key, item in value.iteritems():
+            new_item = _pack(item, attachments)
+            if new_item is not item:
+                if packed is None:
+                    packed = dict(value)
+                packed[key] = new_item
+        return value if packed is None else packed
+    if value_type in CONTAINER_TYPES:
+        packed = None
+        for index, item in enumerate(value):
+            new_item = _pack(item, attachments)
+            if new_item is not item:
+                if packed is None:
+                    packed = list(value)
+                packed[index] = new_item
+        return value if packed is None else packed
+    return value
+
+def unpack(message, attachments):
+    """ Puts attachments back where the message refers to them """
+    if not attachments:
+        return message
+    return _unpack(message, attachments)
+
+def _unpack(value, attachments):
+    """ Replaces attachment references with the attachments """
+    value_type = type(value)
+    if value_type is dict:
+        if len(value) == 1 and value.has_key(ATTACHMENT):
+            return attachments[value[ATTACHMENT]]
+        for key, item in value.iteritems():
+            value[key] = _unpack(item, attachments)
+    elif value_type is list:
+        for index, item in enumerate(value):
+            value[index] = _unpack(item, attachments)
+    return value
+
+def split(socket_type, frames):
+    """ Splits received frames into (envelope, body, attachments).
+    Raises MalformedMessage if there's no body where it should be.
+    """
+    if socket_type == zmq.ROUTER:
+        # the routing ids, up to and including the empty delimiter
+        start = 0
+        while start < len(frames) and len(frames[start]):
+            start += 1
+        if start == len(frames):
+            raise MalformedMessage("No delimiter after the routing ids")
+        start += 1
+    elif socket_type in (zmq.SUB, zmq.DEALER):
+        start = 1 # the topic, or the delimiter
+    else:
+        start = 0
+    if start >= len(frames):
+        raise MalformedMessage("No message body")
+    return frames[:start], frames[start], frames[start+1:]
+
+def recv(socket):
+    """ Receives a message, returning (envelope, message). Raises
+    MalformedMessage for frames that can't be split or decoded -- the
+    message is consumed either way.
+    """
+    frames = socket.recv_multipart(copy=False)
+    envelope, body, attachments = split(socket.socket_type, frames)
+    try:
+        message = codec.decode(body.bytes)
+        if attachments:
+            message = unpack(message,
+                             [frame.buffer for frame in attachments])
+    except (ValueError, TypeError, KeyError, IndexError), error:
+        raise MalformedMessage("Undecodable message body: %s" % error)
+    return [frame.bytes for frame in envelope], message
+
+def send(socket, message, message_codec, envelope=None):
+    """ Encodes and sends a message after the envelope frames,
+    with any binary values as attachment frames.
+    """
+    message, attachments = pack(message)
+    frames = list(envelope or [])
+    frames.append(message_codec.encode(message))
+    if not attachments:
+        socket.send_multipart(frames)
+        return
+    frames.extend(attachments)
+    socket.send_multipart(frames, copy=False)
@@ -0,0 +1,175 @@
+""" An append-only journal of broker task state, for surviving restarts.
+
+Every task state change is appended as one JSON line. Records are written
+in groups: append() only buffers, and commit() writes and fsyncs the whole
+group once it is big enough or old enough. Once the journal gets long it is
+compacted into a snapshot of the current state and started over, so replay
+on startup is one snapshot load plus a short tail of records.
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+import collections
+import zerotask
+from zerotask import frames
+
+# Record types
+CLIENT = "client"
+CLIENT_GONE = "client_gone"
+QUEUED = "queued"
+ASSIGNED = "assigned"
+REQUEUED = "requeued"
+FINISHED = "finished"
+FAILED = "failed"
+COLLECTED = "collected"
+
+
+def encode(data):
+    """ JSON-encodes data, with binary values as base64 attachments """
+    data, attachments = frames.pack(data)
+    attachments = [base64.b64encode(memoryview(a).tobytes())
+                   for a in attachments]
+    return json.dumps([data, attachments])
+
+def decode(line):
+    """ Reverses encode() """
+    data, attachments = json.loads(line)
+    attachments = [bytearray(base64.b64decode(a)) for a in attachments]
+    return frames.unpack(data, attachments)
+
+def apply_record(record, tasks, clients):
+    """ Applies one [kind, key, data] record to the state. Replica
+    brokers use this for the records they're sent, too.
+    """
+    kind, key, data = record
+    if kind == CLIENT:
+        clients[key] = data
+    elif kind == CLIENT_GONE:
+        clients.pop(key, None)
+    elif kind == QUEUED:
+        tasks[key] = data
+    elif not tasks.has_key(key):
+        return # collected before a snapshot
+    elif kind == ASSIGNED:
+        tasks[key]["_status"] = zerotask.ASSIGNED
+        tasks[key]["_node"] = data
+    elif kind == REQUEUED:
+        tasks[key]["_status"] = zerotask.QUEUED
+    elif kind == FINISHED:
+        tasks[key]["_status"] = zerotask.FINISHED
+        tasks[key]["result"] = data
+    elif kind == FAILED:
+        tasks[key]["_status"] = zerotask.FAILED
+        tasks[key]["error"] = data
+    elif kind == COLLECTED:
+        del tasks[key]
+
+
+class Journal(object):
+    """ The write-ahead log (and snapshot) for one broker """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.snapshot_path = "%s.snapshot" % path
+        # group commit -- at most this many records or seconds per fsync
+        self.sync_size = kwargs.get("sync_size", 1000)
+        self.sync_interval = kwargs.get("sync_interval", 0.005)
+        # records since the last snapshot before compacting
+        self.compact_size = kwargs.get("compact_size", 100000)
+        self.buffer = []
+        self.records = 0
+        self.first_pending = None
+        self.file = None
+
+    def replay(self):
+        """ Loads the snapshot and applies the journal on top of it.
+        Returns (tasks, clients), with tasks in the order they were queued.
+        """
+        tasks = collections.OrderedDict()
+        clients = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as snapshot:
+                state = decode(snapshot.read())
+            for task_id, task in state["tasks"]:
+                tasks[task_id] = task
+            clients.update(state["clients"])
+        self.records = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r+") as journal:
+                whole = 0 # the offset just past the last whole record
+                for line in iter(journal.readline, ""):
+                    if not line.endswith("\n"):
+                        logging.warning("Skipping partial journal record.")
+                        break
+                    self.apply(decode(line), tasks, clients)
+                    self.records += 1
+                    whole = journal.tell()
+                # cut off a torn tail, so new records start on a new line
+                journal.truncate(whole)
+        logging.info("Replayed %d tasks and %d journal records.",
+                     len(tasks), self.records)
+        self.file = open(self.path, "a")
+        return tasks, clients
+
+    def apply(self, record, tasks, clients):
+        """ Applies one record to the state """
+        apply_record(record, tasks, clients)
+
+    def append(self, kind, key, data=None):
+        """ Buffers a record until the next commit """
+        if not self.buffer:
+            self.first_pending = time.time()
+        self.buffer.append(encode([kind, key, data]))
+
+    def pending(self):
+        """ Returns True if there are uncommitted records """
+        return bool(self.buffer)
+
+    def due(self):
+        """ Returns True if the buffered group should be committed """
+        if not self.buffer:
+            return False
+        if len(self.buffer) >= self.sync_size:
+            return True
+        return time.time() - self.first_pending >= self.sync_interval
+
+    def commit(self):
+        """ Writes and fsyncs every buffered record at once """
+        if not self.buffer:
+            return
+        self.file.write("\n".join(self.buffer) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += len(self.buffer)
+        self.buffer = []
+
+    def needs_compaction(self):
+        """ Returns True once the journal is long enough to compact """
+        return self.records >= self.compact_size
+
+    def compact(self, tasks, clients):
+        """ Writes a snapshot of the current state and truncates the
+        journal. Call it right after a commit.
+        """
+        self.commit()
+        temp_path = "%s.tmp" % self.snapshot_path
+        with open(temp_path, "w") as snapshot:
+            snapshot.write(encode(dict(tasks=tasks.items(),
+                                       clients=clients)))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_path, self.snapshot_path)
+        self.file.close()
+        self.file = open(self.path, "w")
+        self.records = 0
+        logging.info("Compacted journal to %d tasks.", len(tasks))
+
+    def close(self):
+        """ Commits anything left and closes the file """
+        if self.file:
+            self.commit()
+            self.file.close()
+            self.file = None
@@ -13,7 +13,9 @@ MESSAGES = { -32700: "Parse error.",
              -32010: "Invalid client id.",
              -32020: "Invalid task id.",
              -32030: "Invalid node id.",
-             -32050: "Task not complete." }
+             -32050: "Task not complete.",
+             -32060: "Task result expired.",
+             -32070: "Read-only replica." }
 
 # Constants for readability
 INVALID_REQUEST = -32600
@@ -24,6 +26,8 @@ INVALID_CLIENT_ID = -32010
 INVALID_TASK_ID = -32020
 INVALID_NODE_ID = -32030
 TASK_NOT_COMPLETE = -32050
+RESULT_EXPIRED = -32060
+READ_ONLY = -32070
 
 
 def get_random_id():
@@ -1,77 +1,164 @@
 """ The Node class """
 
 import zmq
+import time
 import logging
 import tempfile
+import threading
+import functools
+import collections
+import zerotask
 from zerotask.server import Server
 from zerotask.task import task
 from zerotask import jsonrpc
+from zerotask import frames
+from zerotask import stats
 from zerotask.exceptions import JSONRPCError
-from zerotask.worker import Worker
+from zerotask import worker
 from multiprocessing import Process
 import optparse
 
+SUPERVISE_INTERVAL = 0.5 # seconds between worker pool checks
+RETIRE_TIMEOUT = 5 # seconds to wait for embedded workers to finish up
+STATS_INTERVAL = 5 # seconds between stats reports to the broker
+HEARTBEAT_INTERVAL = 10 # seconds between heartbeats to each broker
+# seconds to wait on a broker's reply before giving up on it
+REQUEST_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+def is_response(message):
+    """ Returns True for a JSON-RPC response (not a request) """
+    return type(message) is dict and not message.has_key("method")
+
+# Worker states
+STARTING = "starting"
+READY = "ready"
+RETIRING = "retiring"
+
 class Node(Server):
     """ A simple example server """
 
     namespace = "zerotask.node"
 
     def __init__(self, **kwargs):
+        # import task modules up front, so every worker forks warm
+        for module in kwargs.get("imports", []):
+            __import__(module)
+        # the first broker picks the id, and the others are told it
         self.node_id = kwargs.get("node_id", None)
-        self.running_tasks = 0
-        self.workers = []
+        self.running_tasks = 0 # assigned to us and not finished yet
+        self.workers = {} # name -> worker info
+        self.spawned = 0
         self.worker_count = kwargs.get("workers", 1) # 1 worker by default
-        Server.__init__(self)
+        # workers run as threads in this process, over inproc, instead of
+        # as forked processes over ipc
+        self.embedded = kwargs.get("embedded", False)
+        # the pool scales between these with the local backlog
+        self.min_workers = kwargs.get("min_workers")
+        if self.min_workers is None:
+            self.min_workers = self.worker_count
+        self.max_workers = max(self.min_workers, self.worker_count,
+                               kwargs.get("max_workers") or 0)
+        self.worker_count = max(self.worker_count, self.min_workers)
+        # seconds a worker sits idle before scaling down
+        self.idle_timeout = kwargs.get("idle_timeout", 30)
+        # recycle workers after this many tasks / megabytes of RSS
+        self.max_tasks = kwargs.get("max_tasks")
+        self.max_rss = kwargs.get("max_rss")
+        # workers profile this fraction of tasks, dumping them here
+        self.profile_rate = kwargs.get("profile_rate")
+        self.profile_path = kwargs.get("profile_path")
+        # process, thread or asyncio -- see zerotask.worker
+        self.worker_mode = kwargs.get("worker_mode", worker.PROCESS)
+        if self.max_rss and (self.embedded or
+                             self.worker_mode != worker.PROCESS):
+            logging.warning("max_rss only applies to process mode workers")
+        self.concurrency = 1 # tasks at once per worker
+        if self.worker_mode != worker.PROCESS:
+            self.concurrency = max(1, kwargs.get("concurrency", 1))
+        # most tasks the node holds at once (running plus waiting),
+        # split evenly between the brokers
+        self.prefetch = max(1, kwargs.get("prefetch") or
+                               self.max_workers * self.concurrency)
+        # one dict per broker (shard) -- sockets, credits and results
+        self.brokers = []
+        self.task_brokers = {} # task id -> the broker that assigned it
+        self.current_broker = None # the broker of the message at hand
+        self.idle_workers = collections.deque() # one envelope per free slot
+        self.backlog = collections.deque() # tasks waiting for a worker
+        # broker requests still waiting on a reply, by id -- with the
+        # method, callback, broker uri and when each was sent
+        self.pending_requests = {}
+        # finished tasks are reported in batches of up to this many, at
+        # most this many seconds after the first one finished
+        self.result_batch_size = kwargs.get("result_batch_size", 100)
+        self.result_batch_delay = kwargs.get("result_batch_delay", 0.002)
+        self.flush_timeout = None # set while a batch is waiting
+        self.stats = stats.Stats()
+        self.task_times = {} # task id -> [method, assigned / started]
+        Server.__init__(self, **kwargs)
 
     def setup(self):
         """ Sets up the handlers """
-        self.broker_req_socket = None
-        self.broker_sub_socket = None
-        self._push_file = tempfile.NamedTemporaryFile(prefix="zerotaskq-")
-        self._pull_file = tempfile.NamedTemporaryFile(prefix="zerotaskr-")
-        self.push_socket = self.context.socket(zmq.PUSH)
-        self.push_socket.bind("ipc://%s" % self._push_file.name)
-        self.pull_socket = self.context.socket(zmq.PULL)
-        self.pull_socket.bind("ipc://%s" % self._pull_file.name)
-        self.add_callback(self.pull_socket, self.worker_task_result)
-        self.add_handler(self.task_ready)
+        self._worker_file = None
+        if self.embedded:
+            self.worker_uri = "inproc://zerotask-workers-%d" % id(self)
+        else:
+            self._worker_file = tempfile.NamedTemporaryFile(
+                prefix="zerotaskw-")
+            self.worker_uri = "ipc://%s" % self._worker_file.name
+        # ROUTER, so each task goes to a worker that's actually free
+        self.worker_socket = self.context.socket(zmq.ROUTER)
+        self.worker_socket.bind(self.worker_uri)
+        self.add_callback(self.worker_socket, self.worker_message,
+                          routed=True)
+        self.add_periodic(self.supervise, SUPERVISE_INTERVAL)
+        self.add_periodic(self.send_stats, STATS_INTERVAL)
+        self.add_periodic(self.send_heartbeats, HEARTBEAT_INTERVAL)
+        self.add_handler(self.task_assigned)
+        self.add_handler(self.task_parts_acked)
         self.add_handler(self.request_status)
 
     def teardown(self):
-        """ Closes temp files """
+        """ Stops the workers and closes temp files """
+        self.flush_results()
+        if self.embedded:
+            # threads can't be killed -- ask them to finish up instead
+            for name in self.workers.keys():
+                self.retire_worker(name)
+            for info in self.workers.values():
+                info["process"].join(RETIRE_TIMEOUT)
+            return
+        for info in self.workers.values():
+            info["process"].terminate()
         logging.info("Closing temporary files")
-        self._push_file.close()
-        self._pull_file.close()
+        self._worker_file.close()
 
     def start(self):
         """ Checks if broker is setup, then starts the loop """
-        if not self.broker_req_socket or not self.broker_sub_socket:
+        if not self.brokers:
             self.add_broker("tcp://127.0.0.1:5555", "tcp://127.0.0.1:5556")
         logging.info("Starting up %s workers...", self.worker_count)
         for i in range(self.worker_count):
-            push_file = self._push_file.name
-            pull_file = self._pull_file.name
-            def worker_func():
-                worker = Worker(queue=push_file, result=pull_file,
-                                name="worker-%d" % i)
-                worker.start()
-            process = Process(target=worker_func)
-            self.workers.append(process)
-            process.start()
+            self.spawn_worker()
+        # the broker pushes tasks as they queue, up to the prefetch limit
+        self.send_credits()
         Server.start(self)
 
     def add_broker(self, broker_req_uri, broker_sub_uri):
-        """ Sets the (only) broker """
-        self.broker_req_socket = self.context.socket(zmq.REQ)
-        self.broker_sub_socket = self.context.socket(zmq.SUB)
-        self.broker_req_socket.connect(broker_req_uri)
-        self.broker_sub_socket.connect(broker_sub_uri)
-        self.broker_sub_socket.setsockopt(zmq.SUBSCRIBE, "")
+        """ Adds a broker. With several (sharded) brokers, the node
+        takes tasks from all of them.
+        """
+        broker = dict(uri=broker_req_uri, credits=0, running=0, results=[],
+                      started=[])
+        broker["sub_socket"] = self.context.socket(zmq.SUB)
+        # everything to and from the broker goes over this one DEALER
+        broker["socket"] = self.context.socket(zmq.DEALER)
+        broker["socket"].connect(broker_req_uri)
+        broker["sub_socket"].connect(broker_sub_uri)
+        # skip the client result notifications
+        broker["sub_socket"].setsockopt(zmq.SUBSCRIBE, self.namespace)
         # Getting node id from broker
-        connect_method = "zerotask.broker.node_connect"
-        connect_request = jsonrpc.request(connect_method)
-        self.broker_req_socket.send_json(connect_request)
-        connect_result = self.broker_req_socket.recv_json()
+        connect_result = self.broker_call(self.connect_request(), broker)
         if connect_result.has_key("error"):
             connect_error = connect_result["error"]
             raise JSONRPCError(connect_error["code"],
@@ -80,75 +167,435 @@ class Node(Server):
         if not node_id:
             raise JSONRPCError(jsonrpc.INVALID_NODE_ID)
         self.node_id = node_id
-        logging.info("New node id: %s", node_id)
-        self.add_callback(self.broker_sub_socket, self.subscribe)
+        logging.info("New node id: %s (from %s)", node_id, broker_req_uri)
+        self.brokers.append(broker)
+        if self.prefetch < len(self.brokers):
+            # every shard needs a credit, or we'd never take its tasks
+            logging.warning("Raising prefetch to %d, one per broker",
+                            len(self.brokers))
+            self.prefetch = len(self.brokers)
+        self.add_callback(broker["sub_socket"],
+                          functools.partial(self.subscribe, broker=broker))
+        self.add_callback(broker["socket"],
+                          functools.partial(self.broker_message,
+                                            broker=broker))
+
+    def connect_request(self):
+        """ Returns a node_connect request, with our id if we have one """
+        connect_method = "zerotask.broker.node_connect"
+        connect_params = dict(methods=self.task_methods(),
+                              pure=self.pure_methods())
+        if self.node_id:
+            connect_params["node_id"] = self.node_id
+        return jsonrpc.request(connect_method, connect_params)
+
+    def task_methods(self):
+        """ Returns the task methods this node's workers can run """
+        return sorted([name for name in self.dispatcher.handlers
+                       if not name.startswith("zerotask.")])
+
+    def pure_methods(self):
+        """ Returns the task methods marked pure (cacheable) """
+        return sorted([name for name in self.task_methods()
+                       if name in self.dispatcher.pure])
+
+    def broker_request(self, request, broker, callback=None):
+        """ Sends a request to a broker without waiting for it. The
+        reply is matched up by id later and passed to callback, if any.
+        """
+        if request.get("id") is not None:
+            self.pending_requests[request["id"]] = (request["method"],
+                                                    callback, broker["uri"],
+                                                    time.time())
+        self.send(broker["socket"], request, [""])
+
+    def broker_call(self, request, broker):
+        """ Sends a request to a broker and waits for the reply. Only
+        for setup -- the loop should never block on the broker.
+        """
+        self.send(broker["socket"], request, [""])
+        while True:
+            message = frames.recv(broker["socket"])[1]
+            if is_response(message) and message.get("id") == request["id"]:
+                return message
+            self.broker_message(message, broker)
 
-    def subscribe(self, message):
+    def broker_message(self, message, broker):
+        """ Handles a reply to one of our requests, or a push from the
+        broker (like new tasks)
+        """
+        if not is_response(message):
+            return self.subscribe(message, broker)
+        method, callback = self.pending_requests.pop(message.get("id"),
+                                                     (None, None))[:2]
+        if callback:
+            callback(message)
+        elif message.has_key("error"):
+            logging.warning("Broker error for %s: %s", method,
+                            message["error"])
+
+    def subscribe(self, message, broker):
         """ Special dispatching """
         logging.info("Received message %s", message)
+        self.current_broker = broker
         result = self.dispatcher.dispatch(message)
+        self.current_broker = None
         if result:
-            self.broker_req_socket.send_json(result)
-            self.broker_req_socket.recv_json()
+            self.send(broker["socket"], result, [""])
+
+    # The worker pool...
+
+    def spawn_worker(self):
+        """ Forks a new worker from this (already warm) process, or
+        starts one in a thread when embedded
+        """
+        self.spawned += 1
+        name = "worker-%d" % self.spawned
+        options = dict(queue_uri=self.worker_uri, name=name,
+                       codec=self.codec.name, mode=self.worker_mode,
+                       concurrency=self.concurrency,
+                       max_tasks=self.max_tasks, max_rss=self.max_rss,
+                       profile_rate=self.profile_rate,
+                       profile_path=self.profile_path)
+        if self.embedded:
+            options["context"] = self.context
+            process = threading.Thread(target=worker.run_worker,
+                                       kwargs=options, name=name)
+            process.daemon = True
+        else:
+            process = Process(target=worker.run_worker, kwargs=options)
+        process.start()
+        self.workers[name] = dict(process=process, state=STARTING,
+                                  tasks=set(), idle_since=time.time())
+        logging.info("Started %s (%s)", name, self.embedded and "thread" or
+                     "pid %d" % process.pid)
+
+    def supervise(self):
+        """ Respawns dead workers and scales the pool with the backlog """
+        # anything a worker sent before exiting counts
+        while self.worker_socket.poll(0):
+            envelope, message = frames.recv(self.worker_socket)
+            self.worker_message(message, envelope)
+        for name, info in self.workers.items():
+            if info["process"].is_alive():
+                continue
+            del self.workers[name]
+            self.drop_idle(name)
+            if info["state"] != RETIRING or info["tasks"]:
+                logging.warning("Worker %s died (exit code %s)", name,
+                                getattr(info["process"], "exitcode", None))
+            for task_id in info["tasks"]:
+                error = jsonrpc.error(jsonrpc.INTERNAL_ERROR, task_id,
+                                      "Worker process died.")
+                self.worker_task_result(error)
+        active = [(name, info) for name, info in self.workers.items()
+                  if info["state"] != RETIRING]
+        for i in range(self.min_workers - len(active)):
+            self.spawn_worker()
+        if len(active) < self.min_workers:
+            return
+        starting = [name for name, info in active
+                    if info["state"] == STARTING]
+        if self.backlog and len(active) < self.max_workers and not starting:
+            logging.info("Scaling up for %d waiting tasks", len(self.backlog))
+            self.spawn_worker()
+        elif not self.backlog and len(active) > self.min_workers:
+            now = time.time()
+            for name, info in active:
+                if not info["tasks"] and \
+                        now - info["idle_since"] > self.idle_timeout:
+                    logging.info("Scaling down, retiring %s", name)
+                    self.retire_worker(name)
+                    break
+
+    def retire_worker(self, name):
+        """ Tells an idle worker to exit """
+        self.workers[name]["state"] = RETIRING
+        self.drop_idle(name)
+        retire = jsonrpc.request("zerotask.worker.retire", dict(), id=None)
+        self.send(self.worker_socket, retire, [name, ""])
+
+    def drop_idle(self, name):
+        """ Forgets a worker's free slots """
+        self.idle_workers = collections.deque(
+            [envelope for envelope in self.idle_workers
+             if envelope[0] != name])
+
+    def worker_message(self, message, envelope):
+        """ Handles a result, or a ready / retiring signal, from a worker.
+        A worker that isn't retiring gets its free slots back.
+        """
+        name = envelope[0]
+        info = self.workers.get(name)
+        method = message and message.get("method")
+        slots = 1
+        if method == "zerotask.node.worker_ready":
+            slots = message.get("params", {}).get("slots", 1)
+            if info and info["state"] == STARTING:
+                info["state"] = READY
+        elif method == "zerotask.node.task_status":
+            # progress or parts from a running task -- no slot freed
+            slots = 0
+            self.worker_task_status(**message.get("params", {}))
+        elif method == "zerotask.node.worker_retiring":
+            slots = 0
+            if info and info["state"] != RETIRING:
+                info["state"] = RETIRING
+                self.drop_idle(name)
+                self.spawn_worker() # recycled -- replace it straight away
+        elif not info:
+            # its tasks were already failed when it died
+            logging.warning("Dropping a message from dead worker %s", name)
+            return
+        else:
+            if message:
+                info["tasks"].discard(message.get("id"))
+                if not info["tasks"]:
+                    info["idle_since"] = time.time()
+            self.worker_task_result(message)
+        if info and info["state"] != RETIRING:
+            self.idle_workers.extend([envelope] * slots)
+        self.feed_workers()
+
+    def feed_workers(self):
+        """ Hands waiting tasks to free workers """
+        while self.backlog and self.idle_workers:
+            request = self.backlog.popleft()
+            envelope = self.idle_workers.popleft()
+            self.workers[envelope[0]]["tasks"].add(request["id"])
+            broker = self.task_brokers.get(request["id"])
+            if broker:
+                # reported as running with the next batch of results
+                broker["started"].append(request["id"])
+                self.schedule_flush()
+            times = self.task_times.get(request["id"])
+            if times:
+                now = time.time()
+                self.stats.observe("backlog_wait_seconds", times[0],
+                                   now - times[1])
+                times[1] = now
+            self.send(self.worker_socket, request, envelope)
 
     def worker_task_result(self, result):
-        """ Reports a task result back to broker """
+        """ Queues a task result to report back to broker """
         self.running_tasks -= 1
-        if not result:
-            logging.warning("Why do we have an empty result??")
+        broker = self.task_brokers.pop(result and result.get("id"), None)
+        if broker:
+            broker["running"] -= 1
+        self.send_credits()
+        if not result or not broker:
+            logging.warning("Dropping a result with no task: %s", result)
             return
-        task_id = result.get("id")
-        result_method = "zerotask.broker.node_task_finished"
-        result_params = dict(node_id=self.node_id,
-                             task_id=task_id)
+        report = dict(task_id=result.get("id"))
+        times = self.task_times.pop(report["task_id"], None)
+        if times:
+            self.stats.observe("execution_seconds", times[0],
+                               time.time() - times[1])
+            self.stats.incr(result.has_key("error") and "tasks_failed" or
+                            "tasks_executed", times[0])
         if result.has_key("error"):
-            result_method = "zerotask.broker.node_task_failed"
-            result_params["error"] = result["error"]
+            report["error"] = result["error"]
         else:
-            result_params["result"] = result["result"]
-        result_req = jsonrpc.request(method=result_method,
-                                     params=result_params,
-                                     id=None) # a notification
-        self.broker_req_socket.send_json(result_req)
-        self.broker_req_socket.recv_json()
+            report["result"] = result["result"]
+        broker["results"].append(report)
+        # no point waiting if nothing else is about to finish
+        if len(broker["results"]) >= self.result_batch_size or \
+                not self.running_tasks or not self.result_batch_delay:
+            self.flush_results()
+        else:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        """ Flushes the results (and started tasks) result_batch_delay
+        seconds after the first one came in, unless that's already set up
+        """
+        if self.flush_timeout is None and self.result_batch_delay:
+            self.flush_timeout = self.add_timeout(self.flush_results,
+                                                  self.result_batch_delay)
+
+    def flush_results(self):
+        """ Reports the tasks that started running, then the queued
+        results, to each broker in one message apiece
+        """
+        if self.flush_timeout is not None:
+            self.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        for broker in self.brokers:
+            if broker["started"]:
+                status_method = "zerotask.broker.node_task_status"
+                notifications = [
+                    jsonrpc.request(status_method,
+                                    dict(node_id=self.node_id,
+                                         task_id=task_id,
+                                         status=zerotask.RUNNING),
+                                    id=None) # notification
+                    for task_id in broker["started"]]
+                broker["started"] = []
+                self.send(broker["socket"], notifications, [""])
+            if not broker["results"]:
+                continue
+            results_method = "zerotask.broker.node_task_results"
+            results_params = dict(node_id=self.node_id,
+                                  results=broker["results"])
+            broker["results"] = []
+            results_req = jsonrpc.request(method=results_method,
+                                          params=results_params)
+            self.broker_request(results_req, broker)
+
+    def worker_task_status(self, task_id, **kwargs):
+        """ Passes a running task's progress or parts on to its broker """
+        broker = self.task_brokers.get(task_id)
+        if not broker:
+            return
+        status_params = dict(node_id=self.node_id, task_id=task_id,
+                             status=zerotask.RUNNING)
+        status_params.update(kwargs)
+        notification = jsonrpc.request("zerotask.broker.node_task_status",
+                                       status_params, id=None)
+        self.broker_request(notification, broker)
+
+    def task_parts_acked(self, task_id, count):
+        """ The client took some of a task's parts, so the worker
+        streaming it can send that many more
+        """
+        for name, info in self.workers.items():
+            if task_id in info["tasks"]:
+                acked = jsonrpc.request("zerotask.worker.task_acked",
+                                        dict(task_id=task_id, count=count),
+                                        id=None)
+                self.send(self.worker_socket, acked, [name, ""])
+                return
+
+    def send_heartbeats(self):
+        """ Tells each broker we're still alive, so it doesn't hand our
+        tasks to other nodes
+        """
+        self.expire_requests()
+        if not self.node_id:
+            return
+        for broker in self.brokers:
+            heartbeat = jsonrpc.request("zerotask.broker.node_heartbeat",
+                                        dict(node_id=self.node_id))
+            self.broker_request(heartbeat, broker,
+                                functools.partial(self.heartbeat_reply,
+                                                  broker=broker))
+
+    def expire_requests(self):
+        """ Forgets requests a broker never answered, so a dead or
+        restarted broker doesn't leave them behind forever
+        """
+        cutoff = time.time() - REQUEST_TIMEOUT
+        for request_id, pending in self.pending_requests.items():
+            method, callback, uri, sent = pending
+            if sent < cutoff:
+                logging.warning("No reply from broker %s for %s -- "
+                                "giving up on it", uri, method)
+                del self.pending_requests[request_id]
+
+    def heartbeat_reply(self, message, broker):
+        """ Connects again to a broker that gave up on us """
+        error = message.get("error")
+        if not error or error.get("code") != jsonrpc.INVALID_NODE_ID:
+            return
+        logging.warning("Broker %s dropped this node -- connecting again",
+                        broker["uri"])
+        self.broker_request(self.connect_request(), broker,
+                            functools.partial(self.reconnected,
+                                              broker=broker))
+
+    def reconnected(self, message, broker):
+        """ The broker knows us again, but requeued the tasks we held
+        and forgot our credits
+        """
+        if message.has_key("error"):
+            logging.warning("Couldn't connect to broker %s again: %s",
+                            broker["uri"], message["error"])
+            return
+        broker["credits"] = 0
+        self.send_credits()
+
+    def send_credits(self):
+        """ Tops each broker's credits for this node back up to its
+        share of the prefetch limit, so we never hold more tasks than that.
+        When the limit doesn't split evenly, the first brokers get one more.
+        """
+        if not self.brokers:
+            return
+        share, extra = divmod(self.prefetch, len(self.brokers))
+        for index, broker in enumerate(self.brokers):
+            limit = share + (index < extra and 1 or 0)
+            credits = limit - broker["running"] - broker["credits"]
+            if credits < 1:
+                continue
+            broker["credits"] += credits
+            ready_method = "zerotask.broker.node_ready"
+            ready_params = dict(node_id=self.node_id, credits=credits)
+            notification = jsonrpc.request(method=ready_method,
+                                           params=ready_params,
+                                           id=None) # notification
+            self.send(broker["socket"], notification, [""])
 
     # Tasks...
 
-    def task_ready(self, method, task_id):
-        """ Checks if node support the method, and responds if so. """
+    def task_assigned(self, task_id, method, params, chunk=False):
+        """ Receives a task pushed by the broker and queues it for the
+        workers. The broker only sends these while we have credits.
+        A chunk is a list of params, each one a call to the method.
+        """
+        broker = self.current_broker
+        self.running_tasks += 1
+        broker["running"] += 1
+        broker["credits"] = max(0, broker["credits"] - 1)
+        self.task_brokers[task_id] = broker
         if not self.dispatcher.has_handler(method):
-            logging.info("Ignoring -- method %s is not supported.", method)
-            return None # we don't support that method
-        logging.info("Responding for new task %s", method)
-        req_params = dict(node_id=self.node_id, task_id=task_id)
-        req_method = "zerotask.broker.node_task_request"
-        request = jsonrpc.request(req_method, req_params)
-        self.broker_req_socket.send_json(request)
-        result = self.broker_req_socket.recv_json()
-        if result.has_key("error"):
-            raise JSONRPCError(result["error"]["code"],
-                               result["error"].get("message"))
-        task_result = result.get("result")
-        if not task_result:
-            return None # we were not elected
-        method = task_result['method']
-        params = task_result.get("params", [])
-        request = jsonrpc.request(method, params, id=task_id)
+            logging.warning("Method %s is not supported.", method)
+            error = jsonrpc.error(jsonrpc.METHOD_NOT_FOUND, task_id)
+            self.worker_task_result(error)
+            return None
+        if chunk:
+            request = jsonrpc.request(worker.MAP_METHOD,
+                                      dict(method=method, items=params),
+                                      id=task_id)
+        else:
+            request = jsonrpc.request(method, params, id=task_id)
         logging.info("Assigning new request: %s", request)
-        self.push_socket.send_json(request)
-        self.running_tasks += 1
+        self.task_times[task_id] = [method, time.time()]
+        self.backlog.append(request)
+        self.feed_workers()
+
+    def send_stats(self):
+        """ Reports this node's stats to the broker """
+        if not self.node_id:
+            return
+        active = [info for info in self.workers.values()
+                  if info["state"] != RETIRING]
+        busy = sum([len(info["tasks"]) for info in self.workers.values()])
+        slots = len(active) * self.concurrency
+        self.stats.gauge("workers", value=len(active))
+        self.stats.gauge("worker_slots", value=slots)
+        self.stats.gauge("busy_slots", value=busy)
+        self.stats.gauge("worker_utilization",
+                         value=slots and float(busy) / slots or 0.0)
+        self.stats.gauge("backlog", value=len(self.backlog))
+        stats_method = "zerotask.broker.node_stats"
+        stats_params = dict(node_id=self.node_id,
+                            stats=self.stats.snapshot())
+        notification = jsonrpc.request(method=stats_method,
+                                       params=stats_params,
+                                       id=None) # notification
+        # every shard gets them, so any of them can report on the node
+        for broker in self.brokers:
+            self.broker_request(notification, broker)
 
     def request_status(self):
         """ Calls broker with the current node status """
         notify_method = "zerotask.broker.node_status"
         notify_params = dict(node_id=self.node_id,
                              workers=1)
-        notification = jsonrpc.request(method=notify_method,
-                                       params=notify_params,
-                                       id=None) # notification
-        logging.info("Sending status message: %s" % notification)
-        self.broker_req_socket.send_json(notification)
-        self.broker_req_socket.recv_json()
+        status_request = jsonrpc.request(method=notify_method,
+                                         params=notify_params)
+        logging.info("Sending status message: %s" % status_request)
+        self.broker_request(status_request, self.current_broker)
         return None
 
 
@@ -157,17 +604,61 @@ def main():
     options = optparse.OptionParser()
     options.add_option("-w", "--workers", dest="workers", type="int",
                        default=1, help="the number of worker procs")
+    options.add_option("--min-workers", dest="min_workers", type="int",
+                       default=None, help="scale down to this many workers")
+    options.add_option("--max-workers", dest="max_workers", type="int",
+                       default=None, help="scale up to this many workers")
+    options.add_option("--idle-timeout", dest="idle_timeout", type="float",
+                       default=30, help="seconds idle before scaling down")
+    options.add_option("--max-tasks", dest="max_tasks", type="int",
+                       default=None, help="recycle workers after N tasks")
+    options.add_option("--max-rss", dest="max_rss", type="int",
+                       default=None, help="recycle workers over N MB of RSS")
+    options.add_option("--profile-rate", dest="profile_rate", type="float",
+                       default=None, help="fraction of tasks to profile")
+    options.add_option("--profile-path", dest="profile_path", default=None,
+                       help="directory to dump task profiles in")
+    options.add_option("-i", "--import", dest="imports", action="append",
+                       default=[], help="a task module to import")
+    options.add_option("--batch-size", dest="batch_size", type="int",
+                       default=100, help="most results per report")
+    options.add_option("--batch-delay", dest="batch_delay", type="float",
+                       default=0.002, help="seconds to wait for more results "
+                                           "before reporting (0 for none)")
+    options.add_option("-m", "--mode", dest="mode", default=worker.PROCESS,
+                       help="|".join(worker.MODES))
+    options.add_option("-n", "--concurrency", dest="concurrency",
+                       type="int", default=1,
+                       help="tasks at once per worker (thread / asyncio)")
+    options.add_option("-p", "--prefetch", dest="prefetch", type="int",
+                       default=None, help="most tasks held at once (default "
+                                          "max workers * concurrency)")
     options.add_option("-r", "--request_port", dest="req_port", type="int",
                        default=5555, help="the broker's request port")
     options.add_option("-s", "--subscribe_port", dest="sub_port", type="int",
                        default=5556, help="the broker's subscribe port")
     options.add_option("-a", "--address", dest="address",
                        default="*", help="the broker's address")
+    options.add_option("-b", "--broker", dest="brokers", action="append",
+                       default=[], help="ADDRESS:REQUEST_PORT:SUBSCRIBE_PORT"
+                                        " of a broker shard (repeatable, "
+                                        "instead of -a / -r / -s)")
+    options.add_option("-c", "--codec", dest="codec",
+                       default="json", help="json|msgpack")
     options.add_option("-l", "--loglevel", dest="loglevel",
                        default="WARNING", help="INFO|WARNING|ERROR")
 
     opts, args = options.parse_args()
     logging.getLogger().setLevel(getattr(logging, opts.loglevel))
+    brokers = []
+    for broker in opts.brokers:
+        try:
+            address, req_port, sub_port = broker.rsplit(":", 2)
+        except ValueError:
+            options.error("Brokers are ADDRESS:REQUEST_PORT:SUBSCRIBE_PORT")
+        brokers.append((address, req_port, sub_port))
+    if not brokers:
+        brokers.append((opts.address, opts.req_port, opts.sub_port))
     logging.info("Starting with broker request port %d", opts.req_port)
     logging.info("Starting with broker subscribe port %d", opts.sub_port)
 
@@ -181,10 +672,19 @@ def main():
         """ Testing task name attribute """
         return first - second
 
-    node = Node(workers=opts.workers)
-    broker_req_uri = "tcp://%s:%s" % (opts.address, opts.req_port)
-    broker_sub_uri = "tcp://%s:%s" % (opts.address, opts.sub_port)
-    node.add_broker(broker_req_uri, broker_sub_uri)
+    node = Node(workers=opts.workers, codec=opts.codec,
+                worker_mode=opts.mode, concurrency=opts.concurrency,
+                prefetch=opts.prefetch, min_workers=opts.min_workers,
+                max_workers=opts.max_workers,
+                idle_timeout=opts.idle_timeout, max_tasks=opts.max_tasks,
+                max_rss=opts.max_rss, imports=opts.imports,
+                profile_rate=opts.profile_rate,
+                profile_path=opts.profile_path,
+                result_batch_size=opts.batch_size,
+                result_batch_delay=opts.batch_delay)
+    for address, req_port, sub_port in brokers:
+        node.add_broker("tcp://%s:%s" % (address, req_port),
+                        "tcp://%s:%s" % (address, sub_port))
     node.start()
 
 if __name__ == "__main__":
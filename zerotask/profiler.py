@@ -0,0 +1,74 @@
+""" A sampling profiler for dispatched calls.
+
+Only a fraction of calls (the rate) run under cProfile, so it can be left
+on in production. Profiles are added up per method, and can be read back as
+text or dumped to disk as .prof files for pstats / snakeviz / etc.
+"""
+
+import os
+import random
+import pstats
+import logging
+import cProfile
+import StringIO
+import threading
+
+
+class SamplingProfiler(object):
+    """ Profiles a random fraction of handler calls, per method """
+
+    def __init__(self, rate=0.01, path=None):
+        self.rate = rate
+        self.path = path # where dump() writes, if it isn't given one
+        self.stats = {} # method -> pstats.Stats
+        self.samples = {} # method -> profiled calls
+        self.lock = threading.Lock() # thread-pool workers share this
+
+    def sample(self):
+        """ Returns True if the next call should be profiled """
+        return self.rate >= 1 or random.random() < self.rate
+
+    def runcall(self, method, func, args=(), kwargs=None):
+        """ Runs a call under cProfile and adds it to the method's stats """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **(kwargs or {}))
+        finally:
+            profile.create_stats()
+            with self.lock:
+                if self.stats.has_key(method):
+                    self.stats[method].add(profile)
+                else:
+                    self.stats[method] = pstats.Stats(profile)
+                self.samples[method] = self.samples.get(method, 0) + 1
+
+    def report(self, method=None, limit=20, sort="cumulative"):
+        """ Returns {method: pstats text} for one method, or all of them """
+        methods = method and [method] or sorted(self.stats.keys())
+        reports = {}
+        with self.lock:
+            for name in methods:
+                if not self.stats.has_key(name):
+                    continue
+                output = StringIO.StringIO()
+                self.stats[name].stream = output
+                output.write("%d sampled calls\n" % self.samples[name])
+                self.stats[name].sort_stats(sort).print_stats(limit)
+                reports[name] = output.getvalue()
+        return reports
+
+    def dump(self, path=None, prefix=""):
+        """ Writes each method's stats to PATH/PREFIXMETHOD.prof """
+        path = path or self.path
+        if not path:
+            return []
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filenames = []
+        with self.lock:
+            for method, stats in self.stats.items():
+                filename = os.path.join(path, "%s%s.prof" % (prefix, method))
+                stats.dump_stats(filename)
+                filenames.append(filename)
+        logging.info("Dumped %d profiles to %s", len(filenames), path)
+        return filenames
@@ -0,0 +1,57 @@
+""" A consistent hash ring, for spreading task ids over broker shards.
+
+Each shard gets a number of points on the ring, and a key belongs to the
+first shard point at or after its own hash. Adding or removing a shard
+only moves the keys next to its points.
+"""
+
+import bisect
+import hashlib
+
+REPLICAS = 100 # points on the ring per shard
+
+
+def ring_hash(key):
+    """ Returns a 32 bit hash of a string key """
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """ Maps keys (task ids) onto shards (broker uris) """
+
+    def __init__(self, shards=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.shards = []
+        self.points = [] # sorted hashes
+        self.owners = {} # hash -> shard
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard):
+        """ Puts a shard on the ring """
+        if shard in self.shards:
+            return
+        self.shards.append(shard)
+        for i in range(self.replicas):
+            point = ring_hash("%s#%d" % (shard, i))
+            if self.owners.has_key(point):
+                continue # a collision -- the first shard keeps it
+            self.owners[point] = shard
+            bisect.insort(self.points, point)
+
+    def remove(self, shard):
+        """ Takes a shard off the ring """
+        if shard not in self.shards:
+            return
+        self.shards.remove(shard)
+        self.points = [point for point in self.points
+                       if self.owners[point] != shard]
+        self.owners = dict([(point, owner) for point, owner
+                            in self.owners.items() if owner != shard])
+
+    def get(self, key):
+        """ Returns the shard that owns a key """
+        if len(self.shards) < 2:
+            return self.shards and self.shards[0] or None
+        index = bisect.bisect(self.points, ring_hash(key))
+        return self.owners[self.points[index % len(self.points)]]
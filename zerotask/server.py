@@ -1,7 +1,11 @@
 """ A generic ZeroMQ server which uses the poller for multiple sockets """
 
 import zmq
+import math
+import time
 import logging
+from zerotask import codec
+from zerotask import frames
 from zerotask.dispatcher import Dispatcher
 
 class Server(object):
@@ -11,10 +15,20 @@ class Server(object):
 
     def __init__(self, **kwargs):
         self.poller = zmq.Poller()
-        self.context = zmq.Context()
+        # hand in a context to share it (and inproc:// sockets) with
+        # other servers and clients in this process
+        self.own_context = not kwargs.get("context")
+        self.context = kwargs.get("context") or zmq.Context()
         self.dispatcher = kwargs.get("dispatcher", Dispatcher.instance())
+        self.codec = codec.get_codec(kwargs.get("codec", "json"))
         self.callbacks = []
+        self.periodics = []
         self.break_loop = False
+        # stop() can come from another thread, so it's a message
+        self._stop_uri = "inproc://zerotask-stop-%d" % id(self)
+        self._stop_socket = self.context.socket(zmq.PULL)
+        self._stop_socket.bind(self._stop_uri)
+        self.add_callback(self._stop_socket, self.stopped)
         self.setup()
 
     def loop(self):
@@ -22,11 +36,23 @@ class Server(object):
         logging.info("Starting server %s...", self.namespace)
         try:
             while True:
-                socks = dict(self.poller.poll())
-                for socket, callback in self.callbacks:
+                socks = dict(self.poller.poll(self.poll_timeout()))
+                for socket, callback, routed in self.callbacks:
                     if socks.get(socket) == zmq.POLLIN:
-                        data = socket.recv_json()
-                        callback(data)
+                        if socket.closed:
+                            continue # removed by an earlier callback
+                        try:
+                            envelope, data = frames.recv(socket)
+                        except frames.MalformedMessage, error:
+                            logging.warning("Dropping a malformed "
+                                            "message: %s", error)
+                            continue
+                        if routed:
+                            callback(data, envelope)
+                        else:
+                            callback(data)
+                if self.periodics:
+                    self.run_periodics()
                 if self.break_loop:
                     break
         except KeyboardInterrupt:
@@ -39,10 +65,77 @@ class Server(object):
 
     start = loop
 
-    def add_callback(self, socket, callback):
-        """ Adds a socket and callback to the poller and callbacks list """
+    def stop(self):
+        """ Stops the loop -- safe to call from any thread """
+        socket = self.context.socket(zmq.PUSH)
+        socket.connect(self._stop_uri)
+        self.send(socket, {})
+        socket.close()
+
+    def stopped(self, message):
+        """ Breaks the loop after a stop() """
+        self.break_loop = True
+
+    def add_callback(self, socket, callback, routed=False):
+        """ Adds a socket and callback to the poller and callbacks list.
+        Callbacks for routed (ROUTER) sockets also receive the envelope,
+        so replies can be sent back to the right peer.
+        """
         self.poller.register(socket, zmq.POLLIN)
-        self.callbacks.append((socket, callback))
+        self.callbacks.append((socket, callback, routed))
+
+    def remove_callback(self, socket):
+        """ Stops polling a socket, and closes it """
+        self.poller.unregister(socket)
+        self.callbacks = [callback for callback in self.callbacks
+                          if callback[0] is not socket]
+        socket.close(linger=0)
+
+    def add_periodic(self, callback, interval):
+        """ Calls callback() from the loop every interval seconds """
+        self.periodics.append([time.time() + interval, interval, callback])
+
+    def add_timeout(self, callback, delay):
+        """ Calls callback() from the loop once, delay seconds from now.
+        Returns the timeout, for remove_timeout.
+        """
+        timeout = [time.time() + delay, None, callback]
+        self.periodics.append(timeout)
+        return timeout
+
+    def remove_timeout(self, timeout):
+        """ Cancels a timeout, if it hasn't fired yet """
+        self.periodics = [periodic for periodic in self.periodics
+                          if periodic is not timeout]
+
+    def poll_timeout(self):
+        """ Returns the milliseconds until the next periodic (or
+        timeout) is due
+        """
+        if not self.periodics:
+            return None
+        next_call = min([periodic[0] for periodic in self.periodics])
+        # rounded up, so we don't spin through the last millisecond
+        return max(0, int(math.ceil((next_call - time.time()) * 1000)))
+
+    def run_periodics(self):
+        """ Fires any periodic callbacks (and timeouts) that are due """
+        now = time.time()
+        for periodic in [periodic for periodic in self.periodics
+                         if periodic[0] <= now]:
+            if not [entry for entry in self.periodics if entry is periodic]:
+                continue # removed by an earlier callback
+            if periodic[1] is None:
+                self.remove_timeout(periodic)
+            else:
+                periodic[0] = now + periodic[1]
+            periodic[2]()
+
+    def send(self, socket, message, envelope=None):
+        """ Encodes a message with this server's codec and sends it,
+        after the (routing or topic) envelope frames if there are any.
+        """
+        frames.send(socket, message, self.codec, envelope)
 
     def add_handler(self, method, name=None):
         """ just a wrapper for dispatcher.add_handler """
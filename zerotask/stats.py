@@ -0,0 +1,172 @@
+""" Counters, gauges and histograms for brokers and nodes.
+
+Recording is a dict update (plus a bisect for histograms), so it's cheap
+enough for every task. Everything is keyed by metric name and task method
+("" for metrics that aren't per method). snapshot() turns a Stats into
+plain dicts that can travel over JSON-RPC, and prometheus() renders any
+number of snapshots in the Prometheus text format.
+"""
+
+import zmq
+import json
+import bisect
+import optparse
+from zerotask import jsonrpc
+from zerotask import frames
+from zerotask import codec
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """ Counts observations into fixed buckets """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Records one value """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """ Estimates a quantile as the upper bound of its bucket """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index < len(self.buckets):
+            return self.buckets[index]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """ Returns the histogram as a dict, with cumulative buckets """
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            seen += count
+            cumulative.append([bound, seen])
+        return dict(count=self.count, sum=self.sum, buckets=cumulative,
+                    p50=self.quantile(0.5), p99=self.quantile(0.99))
+
+
+class Stats(object):
+    """ The metrics for one broker or node """
+
+    def __init__(self):
+        self.counters = {} # (name, method) -> count
+        self.gauges = {} # (name, method) -> value
+        self.histograms = {} # (name, method) -> Histogram
+
+    def incr(self, name, method="", value=1):
+        """ Adds to a counter """
+        key = (name, method)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, method="", value=0):
+        """ Sets a gauge """
+        self.gauges[(name, method)] = value
+
+    def observe(self, name, method, value):
+        """ Records a value (usually seconds) in a histogram """
+        histogram = self.histograms.get((name, method))
+        if histogram is None:
+            histogram = self.histograms[(name, method)] = Histogram()
+        histogram.observe(value)
+
+    def snapshot(self):
+        """ Returns every metric as {"counters": {name: {method: value}},
+        "gauges": ..., "histograms": ...}
+        """
+        result = dict(counters={}, gauges={}, histograms={})
+        for kind, metrics in (("counters", self.counters),
+                              ("gauges", self.gauges)):
+            for (name, method), value in metrics.iteritems():
+                result[kind].setdefault(name, {})[method] = value
+        for (name, method), histogram in self.histograms.iteritems():
+            result["histograms"].setdefault(name, {})[method] = \
+                histogram.snapshot()
+        return result
+
+
+def format_labels(labels):
+    """ Returns {key="value",...} for the non-empty labels """
+    pairs = ['%s="%s"' % (key, str(value).replace('"', '\\"'))
+             for key, value in sorted(labels.items()) if value != ""]
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(pairs)
+
+def prometheus(snapshots, prefix="zerotask"):
+    """ Renders (labels, snapshot) pairs in the Prometheus text format.
+    The labels (like {"node": NODEID}) are added to every sample.
+    """
+    samples = {} # metric -> (type, lines)
+    for labels, snapshot in snapshots:
+        for kind, suffix, metric_type in (("counters", "_total", "counter"),
+                                          ("gauges", "", "gauge")):
+            for name, values in snapshot.get(kind, {}).iteritems():
+                metric = "%s_%s%s" % (prefix, name, suffix)
+                lines = samples.setdefault(metric, (metric_type, []))[1]
+                for method, value in sorted(values.iteritems()):
+                    sample_labels = dict(labels, method=method)
+                    lines.append("%s%s %s" % (metric,
+                                              format_labels(sample_labels),
+                                              value))
+        for name, values in snapshot.get("histograms", {}).iteritems():
+            metric = "%s_%s" % (prefix, name)
+            lines = samples.setdefault(metric, ("histogram", []))[1]
+            for method, histogram in sorted(values.iteritems()):
+                sample_labels = dict(labels, method=method)
+                for bound, count in histogram["buckets"]:
+                    bucket_labels = dict(sample_labels, le=bound)
+                    lines.append("%s_bucket%s %s" % (
+                        metric, format_labels(bucket_labels), count))
+                lines.append("%s_sum%s %s" % (
+                    metric, format_labels(sample_labels), histogram["sum"]))
+                lines.append("%s_count%s %s" % (
+                    metric, format_labels(sample_labels),
+                    histogram["count"]))
+    output = []
+    for metric in sorted(samples):
+        metric_type, lines = samples[metric]
+        output.append("# TYPE %s %s" % (metric, metric_type))
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+
+def main():
+    """ Prints a broker's stats (JSON or Prometheus text) """
+    options = optparse.OptionParser()
+    options.add_option("-r", "--request_port", dest="req_port", type="int",
+                       default=5555, help="the broker's request port")
+    options.add_option("-a", "--address", dest="address",
+                       default="127.0.0.1", help="the broker's address")
+    options.add_option("-f", "--format", dest="format",
+                       default="json", help="json|prometheus")
+    opts, args = options.parse_args()
+    socket = zmq.Context().socket(zmq.REQ)
+    socket.connect("tcp://%s:%s" % (opts.address, opts.req_port))
+    request = jsonrpc.request("zerotask.broker.stats",
+                              dict(format=opts.format))
+    frames.send(socket, request, codec.get_codec("json"))
+    response = frames.recv(socket)[1]
+    if response.has_key("error"):
+        raise SystemExit(response["error"].get("message"))
+    if opts.format == "prometheus":
+        print response["result"],
+    else:
+        print json.dumps(response["result"], indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+""" A local disk store for results spilled out of broker memory """
+
+import os
+import hashlib
+import logging
+from zerotask import journal
+
+
+class ResultStore(object):
+    """ Keeps one file per spilled result in a directory """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, task_id):
+        """ Returns the file for a task id. Clients pick their task ids,
+        so the file is named for a hash of it, never the id itself.
+        """
+        if type(task_id) is unicode:
+            task_id = task_id.encode("utf-8")
+        digest = hashlib.sha1(task_id).hexdigest()
+        return os.path.join(self.path, "%s.result" % digest)
+
+    def put(self, task_id, result):
+        """ Writes a result to disk """
+        with open(self.filename(task_id), "w") as result_file:
+            result_file.write(journal.encode(result))
+
+    def get(self, task_id):
+        """ Reads a result back from disk """
+        with open(self.filename(task_id)) as result_file:
+            return journal.decode(result_file.read())
+
+    def delete(self, task_id):
+        """ Removes a result from disk, if it's there """
+        try:
+            os.remove(self.filename(task_id))
+        except OSError:
+            logging.warning("Spilled result %s was already gone.", task_id)
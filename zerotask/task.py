@@ -1,11 +1,18 @@
 """ The task decorator(s?) """
 
 import types
+import threading
 from zerotask.dispatcher import Dispatcher
 
+# the task this thread is running, when it's a worker thread
+current = threading.local()
 
-def task(name=None, dispatcher=None):
-    """ A decorator for adding tasks to the dispatcher """
+
+def task(name=None, dispatcher=None, pure=False):
+    """ A decorator for adding tasks to the dispatcher. Mark a task
+    pure=True if its result only depends on its params -- the broker
+    can then answer repeated calls from its cache.
+    """
     func = None
     if type(name) == types.FunctionType:
         func = name
@@ -15,10 +22,19 @@ def task(name=None, dispatcher=None):
 
     def wrap(fn):
         """ Passes the function to wrapper """
-        dispatcher.add_handler(fn, name)
+        dispatcher.add_handler(fn, name, pure=pure)
         return fn
 
     if func:
         return wrap(func)
     return wrap
 
+
+def progress(value):
+    """ Reports how far along the running task is -- any value the codec
+    can handle, like a fraction done -- to the client. Does nothing
+    outside of a worker (or in a coroutine task).
+    """
+    worker = getattr(current, "worker", None)
+    if worker is not None:
+        worker.report_progress(current.task_id, value)
@@ -1,34 +1,410 @@
 """ The Worker class (down with the bourgeoisie?) """
 
 import zmq
+import os
+import time
+import types
+import Queue
 import logging
+import threading
 from zerotask.server import Server
+from zerotask import jsonrpc
+from zerotask.profiler import SamplingProfiler
+from zerotask.task import current
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio # the Python 2 backport
+    except ImportError:
+        asyncio = None
+
+# Worker modes
+PROCESS = "process" # one task at a time, in the worker process itself
+THREAD = "thread" # a pool of threads per worker process
+ASYNCIO = "asyncio" # an asyncio event loop, for coroutine tasks
+MODES = (PROCESS, THREAD, ASYNCIO)
+
+PROFILE_DUMP_INTERVAL = 60 # seconds between profile dumps to disk
+MAP_METHOD = "zerotask.worker.map" # a chunk of calls to one method
+STREAM_WINDOW = 16 # parts a generator task sends ahead of the acks
+PROGRESS_INTERVAL = 0.1 # seconds between progress reports per task
+
+def current_rss():
+    """ Returns this process's resident set size in bytes, or None
+    where /proc isn't there to ask
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+def is_coroutine(value):
+    """ Returns True if a task handed back a coroutine to run """
+    return asyncio is not None and asyncio.iscoroutine(value)
+
+def coroutine_error(result):
+    """ Fails a coroutine task outside of the asyncio mode """
+    result["result"].close()
+    return jsonrpc.error(jsonrpc.INTERNAL_ERROR, result.get("id"),
+                         "Coroutine tasks need the asyncio worker mode.")
+
+def is_stream(handler, result):
+    """ Returns True if a task handed back a generator to stream. In
+    Python 2, coroutines are generators too -- their handlers are marked.
+    """
+    if not result or type(result.get("result")) is not types.GeneratorType:
+        return False
+    return asyncio is None or not asyncio.iscoroutinefunction(handler)
+
+
+class Stream(object):
+    """ A generator task's parts on their way to the client, at most
+    window of them ahead of the client's acks
+    """
+
+    def __init__(self, task_id, generator, window=STREAM_WINDOW):
+        self.task_id = task_id
+        self.generator = generator
+        self.credits = threading.Semaphore(window)
+        self.parts = 0
+
 
 class Worker(Server):
     """ This class handles all the work in a separate process,
     which is started and monitored by the parent node.
     """
-    
+
     namespace = "zerotask.worker"
 
-    def __init__(self, queue, result, **kwargs):
+    def __init__(self, queue=None, **kwargs):
         self.name = kwargs.get("name", "worker")
-        self.queue_uri = "ipc://%s" % queue
-        self.result_uri = "ipc://%s" % result
+        # an ipc file, or any uri (inproc:// for embedded workers)
+        self.queue_uri = kwargs.get("queue_uri") or "ipc://%s" % queue
+        self.mode = kwargs.get("mode", PROCESS)
+        if self.mode not in MODES:
+            raise ValueError("Unknown worker mode %s" % self.mode)
+        if self.mode == ASYNCIO and asyncio is None:
+            raise ValueError("The asyncio worker mode needs asyncio "
+                             "(or trollius)")
+        # tasks run at once -- always 1 in process mode
+        self.concurrency = 1
+        if self.mode != PROCESS:
+            self.concurrency = max(1, kwargs.get("concurrency", 1))
+        # recycle the worker after this many tasks / megabytes of RSS. The
+        # RSS is the whole process's, so it's only the worker's own in
+        # process mode, when the worker isn't a thread of the node.
+        self.max_tasks = kwargs.get("max_tasks") or 0
+        self.max_rss = 0
+        if self.mode == PROCESS and not kwargs.get("context"):
+            self.max_rss = kwargs.get("max_rss") or 0
+        self.running = 0
+        self.completed = 0
+        self.retiring = False
+        self.profile_rate = kwargs.get("profile_rate") or 0
+        self.profile_path = kwargs.get("profile_path")
+        self.results_uri = "inproc://zerotask-results-%d" % id(self)
+        self.streams = {} # task id -> Stream
+        self.progress_sent = {} # task id -> when progress last went out
+        self.progress_pending = {} # task id -> progress held back
+        self._local = threading.local()
         Server.__init__(self, **kwargs)
 
     def setup(self):
-        logging.info("Worker %s listening on %s", self.name, self.queue_uri)
-        logging.info("Worker %s posting to %s", self.name, self.result_uri)
-        self._push_socket = self.context.socket(zmq.PUSH)
-        self._push_socket.connect(self.result_uri)
-        self._pull_socket = self.context.socket(zmq.PULL)
-        self._pull_socket.connect(self.queue_uri)
-        self.add_callback(self._pull_socket, self.receive_task)
-        
+        logging.info("Worker %s talking to %s", self.name, self.queue_uri)
+        self._socket = self.context.socket(zmq.DEALER)
+        # the node tells its workers apart by name
+        self._socket.setsockopt(zmq.IDENTITY, self.name)
+        self._socket.connect(self.queue_uri)
+        self.add_callback(self._socket, self.receive_task)
+        if self.mode != PROCESS:
+            # results from the pool threads / event loop come back here
+            self._results_socket = self.context.socket(zmq.PULL)
+            self._results_socket.bind(self.results_uri)
+            self.add_callback(self._results_socket, self.forward)
+        if self.profile_rate:
+            self.dispatcher.profiler = SamplingProfiler(self.profile_rate,
+                                                        self.profile_path)
+            self.add_periodic(self.dump_profiles, PROFILE_DUMP_INTERVAL)
+        if self.mode == THREAD:
+            self.setup_threads()
+        elif self.mode == ASYNCIO:
+            self.setup_event_loop()
+        # the node only sends tasks to workers that said they're free
+        ready = jsonrpc.request("zerotask.node.worker_ready",
+                                dict(slots=self.concurrency), id=None)
+        self.send(self._socket, ready, [""])
+
+    def setup_threads(self):
+        """ Starts the task thread pool """
+        self.task_queue = Queue.Queue()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self.thread_loop,
+                                      name="%s-%d" % (self.name, i))
+            thread.daemon = True
+            thread.start()
+
+    def setup_event_loop(self):
+        """ Starts the asyncio event loop in its own thread """
+        self.event_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.run_event_loop,
+                                  name="%s-loop" % self.name)
+        thread.daemon = True
+        thread.start()
+
+    def run_event_loop(self):
+        """ Runs the event loop (in its own thread) """
+        asyncio.set_event_loop(self.event_loop)
+        self.event_loop.run_forever()
+
+    def teardown(self):
+        """ Stops the pool threads / event loop """
+        self.dump_profiles()
+        if self.mode == THREAD:
+            for i in range(self.concurrency):
+                self.task_queue.put(None)
+        elif self.mode == ASYNCIO:
+            self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        if self.own_context:
+            # worker processes skip the exit handlers, so flush results now
+            self.context.destroy(linger=1000)
+            return
+        # a thread sharing the node's context -- only close our sockets
+        for socket, callback, routed in self.callbacks:
+            socket.close(linger=1000)
+
     def receive_task(self, task):
         """ Dispatches task """
         logging.info("Received new task %s", task)
-        result = self.dispatcher.dispatch(task)
+        if task.get("method") == "zerotask.worker.retire":
+            # the node is scaling down -- finish up and exit
+            self.retiring = True
+            self.break_loop = not self.running
+            return
+        if task.get("method") == "zerotask.worker.task_acked":
+            self.task_acked(**task.get("params", {}))
+            return
+        self.running += 1
+        if self.mode == THREAD:
+            self.task_queue.put(task)
+            return
+        result = self.run(task)
+        if is_stream(self.dispatcher.handlers.get(task.get("method")),
+                     result):
+            stream = Stream(result.get("id"), result["result"])
+            self.streams[stream.task_id] = stream
+            self.pump(stream)
+            return
+        if result and is_coroutine(result.get("result")):
+            if self.mode != ASYNCIO:
+                result = coroutine_error(result)
+            else:
+                self.event_loop.call_soon_threadsafe(
+                    self.schedule, result["result"], result.get("id"))
+                return
+        self.send_result(result)
+
+    def thread_loop(self):
+        """ Runs tasks from the queue in a pool thread """
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                if getattr(self._local, "socket", None) is not None:
+                    self._local.socket.close(linger=1000)
+                break
+            result = self.run(task)
+            if is_stream(self.dispatcher.handlers.get(task.get("method")),
+                         result):
+                result = self.drain(Stream(result.get("id"),
+                                           result["result"]))
+            if result and is_coroutine(result.get("result")):
+                result = coroutine_error(result)
+            self.post_result(result)
+
+    def run(self, task):
+        """ Dispatches a task, or each call in a chunk task """
+        current.worker, current.task_id = self, task.get("id")
+        try:
+            if task.get("method") != MAP_METHOD:
+                return self.dispatcher.dispatch(task)
+            params = task["params"]
+            return jsonrpc.result(self.map(params["method"],
+                                           params["items"]),
+                                  task.get("id"))
+        finally:
+            current.worker = None
+            self.finish_progress(task.get("id"))
+
+    def pump(self, stream):
+        """ Sends a stream's parts while it has credits, and its result
+        once the generator is done (on the worker loop)
+        """
+        while stream.credits.acquire(False):
+            result = self.next_part(stream)
+            if result is not None:
+                del self.streams[stream.task_id]
+                self.send_result(result)
+                return
+
+    def drain(self, stream):
+        """ Sends all of a stream's parts, waiting for credits as it
+        goes, and returns its result (on a pool thread)
+        """
+        self.streams[stream.task_id] = stream
+        try:
+            while True:
+                stream.credits.acquire()
+                result = self.next_part(stream)
+                if result is not None:
+                    return result
+        finally:
+            self.streams.pop(stream.task_id, None)
+
+    def next_part(self, stream):
+        """ Runs a generator task up to its next part, and sends that on.
+        Returns the task's result (the number of parts) once it's done.
+        """
+        current.worker, current.task_id = self, stream.task_id
+        try:
+            part = next(stream.generator)
+        except StopIteration:
+            self.finish_progress(stream.task_id)
+            return jsonrpc.result(stream.parts, stream.task_id)
+        except Exception, exc:
+            self.finish_progress(stream.task_id)
+            return self.dispatcher.exception_response(exc, stream.task_id)
+        finally:
+            current.worker = None
+        stream.parts += 1
+        try:
+            self.report(stream.task_id, parts=[part])
+        except Exception, exc:
+            # a part the codec can't handle
+            return self.dispatcher.exception_response(exc, stream.task_id)
+        return None
+
+    def task_acked(self, task_id, count=1):
+        """ The client has taken parts of a stream, so it can send more """
+        stream = self.streams.get(task_id)
+        if stream is None:
+            return
+        for i in range(count):
+            stream.credits.release()
+        if self.mode != THREAD:
+            self.pump(stream)
+
+    def report_progress(self, task_id, value):
+        """ Reports a task's progress, at most once per PROGRESS_INTERVAL.
+        Anything held back goes out before the task's result.
+        """
+        now = time.time()
+        if now - self.progress_sent.get(task_id, 0) < PROGRESS_INTERVAL:
+            self.progress_pending[task_id] = value
+            return
+        self.progress_sent[task_id] = now
+        self.progress_pending.pop(task_id, None)
+        self.report(task_id, progress=value)
+
+    def finish_progress(self, task_id):
+        """ Sends any progress held back for a task that's done running """
+        self.progress_sent.pop(task_id, None)
+        if self.progress_pending.has_key(task_id):
+            self.report(task_id, progress=self.progress_pending.pop(task_id))
+
+    def report(self, task_id, **kwargs):
+        """ Sends a running task's progress or parts to the node """
+        status = jsonrpc.request("zerotask.node.task_status",
+                                 dict(task_id=task_id, **kwargs), id=None)
+        if self.mode == THREAD:
+            self.post_result(status)
+        else:
+            self.send(self._socket, status, [""])
+
+    def map(self, method, items):
+        """ Calls a method once per item (a list or dict of params), and
+        returns a {"result"} or {"error"} per call, in order. Chunked calls
+        run one after another, so they can't be coroutines.
+        """
+        results = []
+        for index, params in enumerate(items):
+            request = jsonrpc.request(method, params, id=index + 1)
+            response = self.dispatcher.dispatch(request)
+            if is_coroutine(response.get("result")):
+                response = coroutine_error(response)
+            response.pop("jsonrpc", None)
+            response.pop("id", None)
+            results.append(response)
+        return results
+
+    def schedule(self, coroutine, task_id):
+        """ Runs a coroutine task (called on the event loop thread) """
+        future = asyncio.ensure_future(coroutine, loop=self.event_loop)
+        def done(future):
+            """ Posts the coroutine's result """
+            try:
+                result = jsonrpc.result(future.result(), task_id)
+            except Exception, exc:
+                result = self.dispatcher.exception_response(exc, task_id)
+            self.post_result(result)
+        future.add_done_callback(done)
+
+    def post_result(self, result):
+        """ Hands a result from another thread back to the worker loop.
+        ZeroMQ sockets aren't thread safe, so each thread gets its own.
+        """
+        socket = getattr(self._local, "socket", None)
+        if socket is None:
+            socket = self.context.socket(zmq.PUSH)
+            socket.connect(self.results_uri)
+            self._local.socket = socket
+        self.send(socket, result)
+
+    def forward(self, message):
+        """ Passes a result or status report from a pool thread (or the
+        event loop) on to the node
+        """
+        if message and message.get("method"):
+            self.send(self._socket, message, [""])
+        else:
+            self.send_result(message)
+
+    def send_result(self, result):
+        """ Sends a task result back to the node """
+        self.running -= 1
+        self.completed += 1
+        if not self.retiring and self.worn_out():
+            # before the result, so the node doesn't hand us another task
+            self.retiring = True
+            logging.info("Worker %s retiring after %d tasks", self.name,
+                         self.completed)
+            retiring = jsonrpc.request("zerotask.node.worker_retiring",
+                                       dict(), id=None)
+            self.send(self._socket, retiring, [""])
         logging.info("Sending task result %s", result)
-        self._push_socket.send_json(result)
+        self.send(self._socket, result, [""])
+        if self.retiring and not self.running:
+            self.break_loop = True
+
+    def dump_profiles(self):
+        """ Writes the sampled task profiles to disk, if profiling """
+        if self.dispatcher.profiler is not None:
+            prefix = "%s-%d-" % (self.name, os.getpid())
+            self.dispatcher.profiler.dump(prefix=prefix)
+
+    def worn_out(self):
+        """ Returns True once the worker should be recycled """
+        if self.max_tasks and self.completed >= self.max_tasks:
+            return True
+        if self.max_rss:
+            rss = current_rss()
+            if rss is not None and rss > self.max_rss * 1024 * 1024:
+                return True
+        return False
+
+
+def run_worker(**kwargs):
+    """ The worker process entry point """
+    Worker(**kwargs).start()